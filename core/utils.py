@@ -3,6 +3,8 @@ Core utility functions for MediaCraft backend
 """
 import subprocess
 import logging
+import functools
+import importlib.util
 
 logger = logging.getLogger(__name__)
 
@@ -22,15 +24,33 @@ def get_client_ip(request):
     # 最后使用直接连接的IP（通常是代理服务器）
     return request.remote_addr or 'unknown'
 
+# FFmpeg检测结果，进程内只检测一次
+_ffmpeg_available = None
+
 def check_ffmpeg_availability():
-    """检查FFmpeg是否可用"""
-    try:
-        result = subprocess.run(['ffmpeg', '-version'], 
-                              capture_output=True, text=True, timeout=10)
-        return result.returncode == 0
-    except (subprocess.TimeoutExpired, FileNotFoundError, OSError):
-        logger.warning("FFmpeg is not available on this system")
-        return False
+    """检查FFmpeg是否可用（结果在进程内缓存）"""
+    global _ffmpeg_available
+    if _ffmpeg_available is None:
+        try:
+            result = subprocess.run(['ffmpeg', '-version'], 
+                                  capture_output=True, text=True, timeout=10)
+            _ffmpeg_available = result.returncode == 0
+        except (subprocess.TimeoutExpired, FileNotFoundError, OSError):
+            logger.warning("FFmpeg is not available on this system")
+            _ffmpeg_available = False
+    return _ffmpeg_available
+
+@functools.lru_cache(maxsize=None)
+def find_missing_packages(packages=('cv2', 'numpy', 'flask')):
+    """
+    查找未安装的Python包（结果在进程内缓存）
+    
+    使用find_spec定位包而不执行导入，避免检查时加载cv2等较重的模块
+    
+    Returns:
+        tuple: 未安装的包名
+    """
+    return tuple(name for name in packages if importlib.util.find_spec(name) is None)
 
 def ensure_ffmpeg_available():
     """确保FFmpeg可用，如果不可用则抛出异常"""
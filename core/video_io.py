@@ -0,0 +1,310 @@
+"""
+FFmpeg管道视频读写
+通过FFmpeg子进程解码/编码原始BGR帧，支持硬件加速解码和编码
+"""
+import os
+import subprocess
+import tempfile
+import logging
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# OpenCV的FFmpeg后端默认单线程解码，开启解码器多线程（需在创建VideoCapture之前设置）
+os.environ.setdefault('OPENCV_FFMPEG_CAPTURE_OPTIONS', 'threads;auto')
+
+# 管道缓冲区大小，避免逐帧读写时产生大量小系统调用
+PIPE_BUFFER_SIZE = 1 << 20
+
+# 按优先级排列的硬件解码方式和可直接接收系统内存帧的硬件编码器
+HW_ACCELS = ['cuda', 'vaapi']
+HW_ENCODERS = ['h264_nvenc', 'h264_videotoolbox']
+
+# 同时使用硬件编码器的最大并行任务数（消费级显卡限制并发编码会话数）
+MAX_HW_ENCODE_SESSIONS = 2
+
+# 硬件检测结果，进程内只检测一次
+_hw_codecs = None
+
+def get_hw_codecs() -> Tuple[Optional[str], Optional[str]]:
+    """
+    检测可用的硬件解码加速方式和H.264硬件编码器
+    
+    Returns:
+        Tuple[Optional[str], Optional[str]]: (hwaccel, encoder)，不可用时对应项为None
+    """
+    global _hw_codecs
+    if _hw_codecs is None:
+        _hw_codecs = (_detect_hwaccel(), _detect_hw_encoder())
+        logger.info(f"Hardware codecs detected: hwaccel={_hw_codecs[0]}, encoder={_hw_codecs[1]}")
+    return _hw_codecs
+
+def _run_ffmpeg(args: list) -> subprocess.CompletedProcess:
+    """运行短时FFmpeg检测命令"""
+    return subprocess.run(['ffmpeg', '-hide_banner'] + args, capture_output=True, text=True, timeout=10)
+
+def _detect_hwaccel() -> Optional[str]:
+    """检测可用的硬件解码加速方式"""
+    try:
+        result = _run_ffmpeg(['-hwaccels'])
+        if result.returncode != 0:
+            return None
+        
+        for hwaccel in HW_ACCELS:
+            if hwaccel not in result.stdout.split():
+                continue
+            
+            # 编译支持不代表存在设备，尝试初始化设备
+            probe = _run_ffmpeg(['-v', 'error', '-init_hw_device', hwaccel,
+                                 '-f', 'lavfi', '-i', 'nullsrc=d=0.1', '-f', 'null', '-'])
+            if probe.returncode == 0:
+                return hwaccel
+    except (subprocess.TimeoutExpired, FileNotFoundError, OSError) as e:
+        logger.warning(f"Hardware decoder detection failed: {e}")
+    
+    return None
+
+def _detect_hw_encoder() -> Optional[str]:
+    """检测可用的H.264硬件编码器"""
+    try:
+        result = _run_ffmpeg(['-encoders'])
+        if result.returncode != 0:
+            return None
+        
+        for encoder in HW_ENCODERS:
+            if encoder not in result.stdout:
+                continue
+            
+            # 编译支持不代表存在设备，尝试编码一帧
+            probe = _run_ffmpeg(['-v', 'error', '-f', 'lavfi', '-i', 'color=c=black:s=256x256:d=0.1',
+                                 '-frames:v', '1', '-c:v', encoder, '-f', 'null', '-'])
+            if probe.returncode == 0:
+                return encoder
+    except (subprocess.TimeoutExpired, FileNotFoundError, OSError) as e:
+        logger.warning(f"Hardware encoder detection failed: {e}")
+    
+    return None
+
+def probe_video_packets(input_path: str) -> List[Tuple[Optional[float], bool]]:
+    """
+    使用ffprobe读取第一条视频流的所有数据包（只解析容器，不解码）
+    
+    Returns:
+        List[Tuple[Optional[float], bool]]: 按解码顺序的(pts秒或None, 是否关键帧)，
+            下标即segment复用器计数的帧序号；探测失败时为空列表
+    """
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        input_path
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        if result.returncode != 0:
+            return []
+        packets = []
+        for line in result.stdout.split():
+            pts, _, flags = line.partition(',')
+            packets.append((None if pts in ('', 'N/A') else float(pts), 'K' in flags))
+        return packets
+    except (subprocess.TimeoutExpired, FileNotFoundError, OSError, ValueError) as e:
+        logger.warning(f"ffprobe packet scan failed: {e}")
+        return []
+
+def probe_keyframes(input_path: str, start: Optional[float] = None, end: Optional[float] = None) -> List[float]:
+    """
+    使用ffprobe读取第一条视频流的关键帧时间（只解析数据包，不解码）
+    
+    Args:
+        start: 只读取该时间（秒，相对文件起始时间）附近之后的数据包，None表示从开头读取
+        end: 读到该时间（秒，相对文件起始时间）为止，None表示读到结尾（此时忽略start）
+    
+    Returns:
+        List[float]: 升序的关键帧时间（秒，与输入端-ss一样相对文件起始时间），探测失败时为空列表
+    """
+    try:
+        # 数据包时间戳是绝对时间，需减去文件起始时间（MPEG-TS等不为0）
+        result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=start_time',
+                                 '-of', 'csv=p=0', input_path], capture_output=True, text=True, timeout=30)
+        if result.returncode != 0:
+            return []
+        start_time = result.stdout.strip()
+        offset = float(start_time) if start_time not in ('', 'N/A') else 0.0
+        
+        cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0']
+        if end is not None:
+            # 只读取所需区域（-read_intervals使用绝对时间）
+            begin = '' if start is None else f'{offset + max(0.0, start):.6f}'
+            cmd.extend(['-read_intervals', f'{begin}%{offset + end:.6f}'])
+        cmd.extend(['-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input_path])
+        
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        if result.returncode != 0:
+            return []
+        keyframes = []
+        for line in result.stdout.split():
+            pts, _, flags = line.partition(',')
+            if 'K' in flags and pts not in ('', 'N/A'):
+                keyframes.append(float(pts) - offset)
+        return sorted(keyframes)
+    except (subprocess.TimeoutExpired, FileNotFoundError, OSError, ValueError) as e:
+        logger.warning(f"ffprobe keyframe scan failed: {e}")
+        return []
+
+def open_video_capture(input_path: str) -> cv2.VideoCapture:
+    """
+    打开视频并启用多线程解码
+    
+    OpenCV 4.6+支持在打开时通过CAP_PROP_N_THREADS指定解码线程数，
+    旧版本依赖OPENCV_FFMPEG_CAPTURE_OPTIONS环境变量
+    """
+    if hasattr(cv2, 'CAP_PROP_N_THREADS'):
+        cap = cv2.VideoCapture(input_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, os.cpu_count() or 1])
+        if cap.isOpened():
+            return cap
+        cap.release()
+    
+    return cv2.VideoCapture(input_path)
+
+class FFmpegFrameReader:
+    """通过FFmpeg管道读取BGR帧，接口与cv2.VideoCapture.read/release一致"""
+    
+    def __init__(self, input_path: str, width: int, height: int, hwaccel: Optional[str] = None):
+        self.width = width
+        self.height = height
+        self.frame_size = width * height * 3
+        
+        cmd = ['ffmpeg', '-v', 'error']
+        if hwaccel:
+            cmd.extend(['-hwaccel', hwaccel])
+        cmd.extend(['-i', input_path, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'])
+        
+        # 错误输出写入临时文件，解码失败时用于报告原因（管道无人读取会写满阻塞）
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self.stderr,
+                                        bufsize=PIPE_BUFFER_SIZE)
+    
+    def read(self, image: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        """
+        读取下一帧，读到结尾时返回(False, None)
+        
+        Args:
+            image: 可选的预分配帧缓冲区（与cv2.VideoCapture.read一致），形状匹配时直接写入
+            
+        Raises:
+            RuntimeError: FFmpeg解码中途失败（如硬件初始化失败、显存不足），避免被当作正常结尾
+        """
+        frame = image
+        if frame is None or frame.shape != (self.height, self.width, 3) or not frame.flags.c_contiguous:
+            frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        view = memoryview(frame).cast('B')
+        
+        filled = 0
+        while filled < self.frame_size:
+            count = self.process.stdout.readinto(view[filled:])
+            if not count:
+                # 输出结束：区分正常结尾和解码失败
+                if self.process.wait() != 0:
+                    self.stderr.seek(0)
+                    stderr = self.stderr.read().decode('utf-8', errors='replace')
+                    raise RuntimeError(f"FFmpeg reader failed: {stderr}")
+                return False, None
+            filled += count
+        
+        return True, frame
+    
+    def release(self):
+        """结束FFmpeg进程（提前停止读取时直接终止）"""
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.stderr.close()
+
+class EncoderError(RuntimeError):
+    """FFmpeg编码失败；encoder为所用编码器，硬件编码器失败时调用方可改用libx264重试"""
+    
+    def __init__(self, encoder: str, message: str):
+        super().__init__(message)
+        self.encoder = encoder
+
+class FFmpegFrameWriter:
+    """通过FFmpeg管道写入BGR帧，接口与cv2.VideoWriter.write/release一致"""
+    
+    def __init__(self, output_path: str, width: int, height: int, fps: float, encoder: str = 'libx264',
+                 audio_path: Optional[str] = None):
+        """
+        Args:
+            audio_path: 可选的音频来源文件，指定时在同一次编码中混入其第一条音轨，无需再单独合并音频
+        """
+        cmd = [
+            'ffmpeg', '-y', '-v', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', f'{width}x{height}',
+            '-r', str(fps),
+            '-i', '-'
+        ]
+        if audio_path:
+            cmd.extend([
+                '-i', audio_path,
+                '-map', '0:v:0',   # 管道输入的视频帧
+                '-map', '1:a:0?',  # 原始文件的音频流（如果存在）
+                '-c:a', 'aac',
+                '-shortest'
+            ])
+        cmd.extend([
+            '-c:v', encoder,
+            # yuv420p要求宽高为偶数
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            '-pix_fmt', 'yuv420p',
+            '-threads', '0',  # 编码器自动使用所有核心
+            output_path
+        ])
+        
+        # 错误输出写入临时文件而非管道：编码期间无人读取管道，写满后FFmpeg会阻塞导致死锁
+        self.stderr = tempfile.TemporaryFile()
+        self.encoder = encoder
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self.stderr,
+                                        bufsize=PIPE_BUFFER_SIZE)
+    
+    def isOpened(self) -> bool:
+        """FFmpeg进程是否仍在运行"""
+        return self.process.poll() is None
+    
+    def write(self, frame: np.ndarray):
+        """
+        写入一帧
+        
+        Raises:
+            EncoderError: FFmpeg已退出（如硬件编码会话数超限）
+        """
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError as e:
+            raise EncoderError(self.encoder, f"FFmpeg writer exited while encoding with {self.encoder}") from e
+    
+    def release(self) -> bool:
+        """
+        关闭输入并等待FFmpeg完成编码
+        
+        Returns:
+            bool: 编码是否成功，失败时记录FFmpeg的错误输出（cv2.VideoWriter.release返回None）
+        """
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        
+        success = self.process.wait() == 0
+        if not success:
+            self.stderr.seek(0)
+            stderr = self.stderr.read().decode('utf-8', errors='replace')
+            logger.error(f"FFmpeg writer failed: {stderr}")
+        self.stderr.close()
+        return success
@@ -24,6 +24,8 @@ class MergeVideoItem:
         # Video properties
         self.video_duration = 0.0  # in seconds
         self.video_resolution = ""  # e.g. "1920x1080"
+        self.width = 0
+        self.height = 0
         self.video_format = self._extract_format(original_filename)
         self.fps = 0.0
         self.bitrate = 0
@@ -58,6 +60,8 @@ class MergeVideoItem:
             'file_path': self.file_path,
             'video_duration': self.video_duration,
             'video_resolution': self.video_resolution,
+            'width': self.width,
+            'height': self.height,
             'video_format': self.video_format,
             'fps': self.fps,
             'bitrate': self.bitrate,
@@ -84,6 +88,14 @@ class MergeVideoItem:
         item.item_id = data['item_id']
         item.video_duration = data.get('video_duration', 0.0)
         item.video_resolution = data.get('video_resolution', '')
+        item.width = data.get('width', 0)
+        item.height = data.get('height', 0)
+        if not (item.width and item.height) and item.video_resolution:
+            # Older records only stored the resolution string
+            try:
+                item.width, item.height = map(int, item.video_resolution.split('x'))
+            except ValueError:
+                item.width, item.height = 0, 0
         item.video_format = data.get('video_format', '')
         item.fps = data.get('fps', 0.0)
         item.bitrate = data.get('bitrate', 0)
@@ -6,6 +6,7 @@ import os
 import json
 import time
 import shutil
+from operator import attrgetter
 from typing import Dict, List, Optional, Any, Union
 from datetime import datetime, timedelta
 from config import get_current_config
@@ -225,9 +226,18 @@ class TaskStorage:
             print(f"Failed to delete merge task: {e}")
             return False
     
-    def save_video_items(self, task_uuid: str, items: List[MergeVideoItem]) -> bool:
-        """Save video items to storage"""
+    def save_video_items(self, task_uuid: str, items: List[MergeVideoItem],
+                         task: Optional[VideoMergeTask] = None) -> bool:
+        """
+        Save video items to storage
+        
+        The owning task is re-saved with an updated total_videos count. Pass the in-memory
+        task to persist its other pending changes (e.g. progress) in the same write.
+        """
         try:
+            # Keep items ordered by item_order so readers don't need to sort
+            items = sorted(items, key=attrgetter('item_order'))
+            
             # Update cache
             self.merge_items_cache[task_uuid] = items
             
@@ -240,7 +250,7 @@ class TaskStorage:
                 json.dump(items_data, f, ensure_ascii=False, indent=2)
             
             # Update task total_videos count
-            task = self.get_merge_task(task_uuid)
+            task = task or self.get_merge_task(task_uuid)
             if task:
                 task.total_videos = len(items)
                 self.save_merge_task(task)
@@ -251,7 +261,7 @@ class TaskStorage:
             return False
     
     def get_video_items(self, task_uuid: str) -> List[MergeVideoItem]:
-        """Get video items from storage"""
+        """Get video items from storage, sorted by item_order"""
         try:
             # Check cache first
             if task_uuid in self.merge_items_cache:
@@ -264,6 +274,7 @@ class TaskStorage:
                     items_data = json.load(f)
                 
                 items = [MergeVideoItem.from_dict(item_data) for item_data in items_data]
+                items.sort(key=attrgetter('item_order'))
                 self.merge_items_cache[task_uuid] = items
                 return items
             
@@ -6,20 +6,50 @@ import os
 import sys
 import subprocess
 import tempfile
+import threading
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import attrgetter
 from typing import List, Dict, Tuple, Optional, Any
 import cv2
 
+try:
+    import av  # Optional: in-process probing via PyAV
+except ImportError:
+    av = None
+
 # 确保可以导入 models 和 config 模块
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import config
+from core.video_io import HW_ENCODERS, MAX_HW_ENCODE_SESSIONS, get_hw_codecs, probe_keyframes
 from models.merge_task import VideoMergeTask
 from models.merge_video_item import MergeVideoItem
 from models.storage import TaskStorage
 
 
+def _run_encode(cmd: List[str], timeout: int) -> subprocess.CompletedProcess:
+    """Run an FFmpeg encode, retrying with libx264 if a hardware encoder fails (e.g. GPU session limit)"""
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    
+    codec_index = cmd.index('-c:v') + 1 if '-c:v' in cmd else None
+    if result.returncode != 0 and codec_index and cmd[codec_index] in HW_ENCODERS:
+        print(f"Hardware encoder {cmd[codec_index]} failed, retrying with libx264: {result.stderr}")
+        cmd = cmd[:codec_index] + ['libx264'] + cmd[codec_index + 1:]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    
+    return result
+
+
+def _nonempty(path: str) -> bool:
+    """Check that a file exists and has content with a single stat call"""
+    try:
+        return os.stat(path).st_size > 0
+    except OSError:
+        return False
+
+
 class VideoMerger:
     """Video merger processor for combining multiple videos"""
     
@@ -29,7 +59,13 @@ class VideoMerger:
         self.storage = TaskStorage()
     
     def extract_video_info(self, video_path: str) -> Dict[str, Any]:
-        """Extract video information using OpenCV"""
+        """Extract video information using PyAV if available, otherwise OpenCV and FFprobe"""
+        if av is not None:
+            try:
+                return self._probe_with_av(video_path)
+            except Exception as e:
+                print(f"PyAV probe failed, falling back to FFprobe: {e}")
+        
         try:
             cap = cv2.VideoCapture(video_path)
             if not cap.isOpened():
@@ -62,6 +98,50 @@ class VideoMerger:
         except Exception as e:
             raise Exception(f"Failed to extract video info: {str(e)}")
     
+    def _probe_with_av(self, video_path: str) -> Dict[str, Any]:
+        """Extract video information in-process using PyAV (no ffprobe spawn)"""
+        with av.open(video_path) as container:
+            if not container.streams.video:
+                raise Exception("No video stream found")
+            
+            stream = container.streams.video[0]
+            fps = float(stream.average_rate) if stream.average_rate else 0.0
+            width = stream.codec_context.width
+            height = stream.codec_context.height
+            
+            # codec dimensions are pre-rotation; swap them for portrait (90/270) display matrices
+            rotation = stream.metadata.get('rotate')
+            if rotation is None:
+                frame = next(container.decode(stream), None)
+                rotation = getattr(frame, 'rotation', 0) if frame is not None else 0
+            if abs(int(float(rotation))) % 180 == 90:
+                width, height = height, width
+            
+            if stream.duration is not None and stream.time_base is not None:
+                duration = float(stream.duration * stream.time_base)
+            elif container.duration is not None:
+                duration = container.duration / av.time_base
+            else:
+                duration = 0
+            
+            frame_count = stream.frames or (int(duration * fps) if fps > 0 else 0)
+            # container.bit_rate includes audio; use the video stream's rate, else estimate
+            # from file size as _get_video_bitrate does
+            bitrate = stream.bit_rate
+            if not bitrate:
+                bitrate = int(os.path.getsize(video_path) * 8 / duration) if duration > 0 else 0
+            
+            return {
+                'fps': fps,
+                'frame_count': frame_count,
+                'width': width,
+                'height': height,
+                'duration': duration,
+                'resolution': f"{width}x{height}",
+                'has_audio': len(container.streams.audio) > 0,
+                'bitrate': int(bitrate)
+            }
+    
     def _check_audio_stream(self, video_path: str) -> bool:
         """Check if video has audio stream using FFmpeg"""
         try:
@@ -138,6 +218,8 @@ class VideoMerger:
                 bitrate=info['bitrate'],
                 has_audio=info['has_audio']
             )
+            item.width = info['width']
+            item.height = info['height']
             
             return True
         except Exception as e:
@@ -150,14 +232,14 @@ class VideoMerger:
             return False, "No video items provided"
         
         # Get reference values from first item
-        ref_resolution = items[0].video_resolution
+        ref_size = (items[0].width, items[0].height)
         ref_fps = items[0].fps
         
         # Check if all items have similar properties
         for item in items:
             # Resolution mismatch
-            if item.video_resolution != ref_resolution:
-                return False, f"Resolution mismatch: {item.video_resolution} vs {ref_resolution}"
+            if (item.width, item.height) != ref_size:
+                return False, f"Resolution mismatch: {item.video_resolution} vs {items[0].video_resolution}"
             
             # FPS difference > 1
             if abs(item.fps - ref_fps) > 1:
@@ -178,18 +260,8 @@ class VideoMerger:
             }
         
         # Get highest resolution
-        max_width = 0
-        max_height = 0
-        for item in items:
-            if not item.video_resolution:
-                continue
-                
-            try:
-                width, height = map(int, item.video_resolution.split('x'))
-                max_width = max(max_width, width)
-                max_height = max(max_height, height)
-            except ValueError:
-                continue
+        max_width = max((item.width for item in items if item.width), default=0)
+        max_height = max((item.height for item in items if item.height), default=0)
         
         # If no valid resolution found, use default
         if max_width == 0 or max_height == 0:
@@ -222,7 +294,7 @@ class VideoMerger:
             'resolution': f"{max_width}x{max_height}",
             'fps': max_fps,
             'format': 'mp4',
-            'codec': 'libx264',
+            'codec': get_hw_codecs()[1] or 'libx264',
             'audio_codec': 'aac',
             'bitrate': max_bitrate
         }
@@ -245,21 +317,26 @@ class VideoMerger:
                 print(f"[MERGE] Task {task.task_uuid} - 未找到需要合并的视频项")
                 raise Exception("No video items found for merging")
             
-            # Sort items by order
-            items.sort(key=lambda x: x.item_order)
+            # Sort items by order (storage already returns them sorted, so this is a linear pass)
+            items.sort(key=attrgetter('item_order'))
             
             # Analyze videos if needed
+            items_analyzed = False
             for i, item in enumerate(items):
                 if item.status == 'uploaded':
                     print(f"[MERGE] Task {task.task_uuid} - 分析第{i+1}个视频: {item.original_filename}")
                     self.storage.add_merge_log(task.task_uuid, 'info', f'Analyzing video {i+1}/{len(items)}', 'analyzing')
                     if self.analyze_video_item(item):
                         print(f"[MERGE] Task {task.task_uuid} - 视频分析成功: {item.original_filename}, 时长: {item.video_duration}, 分辨率: {item.video_resolution}, FPS: {item.fps}")
-                        self.storage.update_video_item(task.task_uuid, item)
+                        items_analyzed = True
                     else:
                         print(f"[MERGE] Task {task.task_uuid} - 视频分析失败: {item.original_filename}")
                         raise Exception(f"Failed to analyze video: {item.original_filename}")
             
+            # Persist analysis results in a single write
+            if items_analyzed:
+                self.storage.save_video_items(task.task_uuid, items)
+            
             # Update task progress
             task.progress_percentage = 10
             self.storage.save_merge_task(task)
@@ -287,33 +364,64 @@ class VideoMerger:
             
             # Process video segments
             self.storage.add_merge_log(task.task_uuid, 'info', 'Processing video segments', 'segmenting')
-            segment_files = []
-            
-            for i, item in enumerate(items):
-                # Update progress
-                progress = 10 + int((i / len(items)) * 40)  # 10-50% for segmenting
-                task.progress_percentage = progress
-                self.storage.save_merge_task(task)
+            segment_paths = [None] * len(items)
+            
+            # Encode independent segments in parallel; cap per-job FFmpeg threads
+            # so concurrent jobs don't oversubscribe the CPU
+            cpu_count = os.cpu_count() or 1
+            n_workers = max(1, cpu_count // 4)
+            if output_format['codec'] in HW_ENCODERS:
+                # Consumer GPUs cap concurrent encode sessions
+                n_workers = min(n_workers, MAX_HW_ENCODE_SESSIONS)
+            ffmpeg_threads = max(1, cpu_count // n_workers)
+            
+            # Debounce storage writes: only save when progress moved >= 2% or 0.5s passed
+            last_saved_pct = -10
+            last_saved_ts = 0.0
+            
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                futures = {}
+                for i, item in enumerate(items):
+                    print(f"[MERGE] Task {task.task_uuid} - 处理分段: {item.original_filename}, 起止: {item.start_time}-{item.end_time}")
+                    future = executor.submit(
+                        self._process_video_segment,
+                        item,
+                        segments_dir,
+                        i,
+                        output_format,
+                        ffmpeg_threads
+                    )
+                    futures[future] = i
                 
-                print(f"[MERGE] Task {task.task_uuid} - 处理分段: {item.original_filename}, 起止: {item.start_time}-{item.end_time}")
-                # Process segment
-                segment_path = self._process_video_segment(
-                    item, 
-                    segments_dir, 
-                    i, 
-                    output_format
-                )
-                
-                if segment_path:
-                    print(f"[MERGE] Task {task.task_uuid} - 分段处理成功: {segment_path}")
-                    segment_files.append(segment_path)
-                    item.update_status('completed')
-                else:
-                    print(f"[MERGE] Task {task.task_uuid} - 分段处理失败: {item.original_filename}")
-                    item.update_status('failed')
-                
-                # Update item status
-                self.storage.update_video_item(task.task_uuid, item)
+                for completed, future in enumerate(as_completed(futures), 1):
+                    i = futures[future]
+                    item = items[i]
+                    segment_path = future.result()
+                    
+                    if segment_path:
+                        print(f"[MERGE] Task {task.task_uuid} - 分段处理成功: {segment_path}")
+                        segment_paths[i] = segment_path
+                        item.update_status('completed')
+                    else:
+                        print(f"[MERGE] Task {task.task_uuid} - 分段处理失败: {item.original_filename}")
+                        item.update_status('failed')
+                    
+                    # Update progress
+                    progress = 10 + int((completed / len(items)) * 40)  # 10-50% for segmenting
+                    task.progress_percentage = progress
+                    
+                    now = time.time()
+                    if progress - last_saved_pct >= 2 or now - last_saved_ts > 0.5:
+                        # Also re-saves the task, including its progress
+                        self.storage.save_video_items(task.task_uuid, items, task)
+                        last_saved_pct = progress
+                        last_saved_ts = now
+            
+            # Persist final item statuses
+            self.storage.save_video_items(task.task_uuid, items)
+            
+            # Keep segments in item order
+            segment_files = [path for path in segment_paths if path]
             
             # Check if we have segments to merge
             if not segment_files:
@@ -331,11 +439,14 @@ class VideoMerger:
             output_path = os.path.join(output_dir, output_filename)
             
             # Merge videos
+            total_duration = sum(items[i].segment_duration for i, path in enumerate(segment_paths) if path)
             success = self._merge_video_segments(
                 segment_files,
                 output_path,
                 output_format,
-                task.audio_handling
+                task.audio_handling,
+                task,
+                total_duration
             )
             
             if not success:
@@ -370,7 +481,7 @@ class VideoMerger:
             return False
     
     def _process_video_segment(self, item: MergeVideoItem, output_dir: str, index: int, 
-                             output_format: Dict[str, Any]) -> Optional[str]:
+                             output_format: Dict[str, Any], threads: Optional[int] = None) -> Optional[str]:
         """Process a video segment based on time selection"""
         try:
             # Create output filename
@@ -405,7 +516,24 @@ class VideoMerger:
                     shutil.copy2(item.file_path, segment_path)
                 
                 return segment_path
-            
+
+            # Trim-only: stream copy instead of re-encoding. Stream copy can only start on a
+            # keyframe; any other start would include footage from before the trim point
+            if needs_cutting and not needs_conversion and self._starts_on_keyframe(item):
+                cmd = ['ffmpeg', '-y', '-ss', str(item.start_time), '-i', item.file_path]
+                if item.end_time is not None:
+                    duration = item.end_time - item.start_time
+                    cmd.extend(['-t', str(duration)])
+                cmd.extend(['-c', 'copy', segment_path])
+
+                result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+
+                if result.returncode == 0:
+                    return segment_path
+
+                # Stream copy failed (e.g. keyframe gap), fall back to re-encoding
+                print(f"FFmpeg stream copy failed, re-encoding: {result.stderr}")
+
             # Build FFmpeg command for cutting and/or conversion
             cmd = ['ffmpeg', '-y']
             
@@ -422,9 +550,10 @@ class VideoMerger:
             # Video settings
             cmd.extend([
                 '-c:v', output_format['codec'],
-                '-b:v', str(output_format['bitrate']),
-                '-preset', 'medium'
+                '-b:v', str(output_format['bitrate'])
             ])
+            if output_format['codec'] == 'libx264':
+                cmd.extend(['-preset', 'medium'])
             
             # Resolution conversion if needed
             if needs_conversion:
@@ -436,11 +565,15 @@ class VideoMerger:
             else:
                 cmd.extend(['-an'])  # No audio
             
+            # Limit encoder threads when running alongside other segments
+            if threads:
+                cmd.extend(['-threads', str(threads)])
+            
             # Output file
             cmd.append(segment_path)
             
             # Run FFmpeg command
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+            result = _run_encode(cmd, timeout=600)
             
             if result.returncode != 0:
                 print(f"FFmpeg error: {result.stderr}")
@@ -452,8 +585,19 @@ class VideoMerger:
             print(f"Error processing video segment: {e}")
             return None
     
+    def _starts_on_keyframe(self, item: MergeVideoItem) -> bool:
+        """Check whether the item's start time falls on a keyframe (within half a frame)"""
+        if item.start_time <= 0:
+            return True
+        
+        tolerance = 0.5 / item.fps if item.fps and item.fps > 0 else 0.001
+        # Only read packets around the start point instead of scanning the whole file
+        keyframes = probe_keyframes(item.file_path, start=item.start_time - 1.0, end=item.start_time + tolerance)
+        return any(abs(t - item.start_time) <= tolerance for t in keyframes)
+    
     def _merge_video_segments(self, segment_files: List[str], output_path: str, 
-                            output_format: Dict[str, Any], audio_handling: str) -> bool:
+                            output_format: Dict[str, Any], audio_handling: str,
+                            task: Optional[VideoMergeTask] = None, total_duration: float = 0.0) -> bool:
         """Merge video segments into a single video using a more reliable method"""
         try:
             if not segment_files:
@@ -508,14 +652,14 @@ class VideoMerger:
                     print(f"Running FFmpeg command: {' '.join(cmd)}")
                     
                     # Run FFmpeg command
-                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
+                    result = _run_encode(cmd, timeout=1800)
                     
                     if result.returncode != 0:
                         print(f"FFmpeg merge error: {result.stderr}")
                         raise Exception(f"FFmpeg error: {result.stderr}")
                     
                     # Verify the output file exists and has content
-                    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+                    if not _nonempty(output_path):
                         raise Exception("Output file is empty or does not exist")
                     
                     return True
@@ -534,22 +678,43 @@ class VideoMerger:
                 try:
                     # Build complex filter command
                     inputs = []
-                    filter_complex = []
+                    video_filter = []
+                    audio_filter = []
                     
                     for i, file_path in enumerate(segment_files):
                         inputs.extend(['-i', file_path])
-                        filter_complex.append(f"[{i}:v]scale={output_format['resolution'].replace('x', ':')},fps={output_format['fps']},format=yuv420p[v{i}];")
+                        video_filter.append(f"[{i}:v]scale={output_format['resolution'].replace('x', ':')},fps={output_format['fps']},format=yuv420p[v{i}];")
                     
                     # Concatenate video streams
                     for i in range(len(segment_files)):
-                        filter_complex.append(f"[v{i}]")
+                        video_filter.append(f"[v{i}]")
                     
-                    filter_complex.append(f"concat=n={len(segment_files)}:v=1:a=0[outv]")
+                    video_filter.append(f"concat=n={len(segment_files)}:v=1:a=0[outv]")
+                    
+                    # Audio concatenation with normalization (keep_all)
+                    concat_audio = audio_handling not in ('remove', 'keep_first')
+                    if concat_audio:
+                        audio_inputs = []
+                        
+                        # Build audio normalization filters
+                        for i in range(len(segment_files)):
+                            # Normalize each audio stream to consistent format
+                            audio_filter.append(f"[{i}:a]aformat=sample_rates=44100:channel_layouts=stereo,volume=1.0[a{i}];")
+                            audio_inputs.append(f"[a{i}]")
+                        
+                        # Concatenate normalized audio streams
+                        audio_filter.extend(audio_inputs)
+                        audio_filter.append(f"concat=n={len(segment_files)}:v=0:a=1[outa]")
+                    
+                    # Build the whole filter graph once
+                    full_filter = ''.join(video_filter)
+                    if audio_filter:
+                        full_filter += ';' + ''.join(audio_filter)
                     
                     # Build FFmpeg command
                     cmd = ['ffmpeg', '-y']
                     cmd.extend(inputs)
-                    cmd.extend(['-filter_complex', ''.join(filter_complex)])
+                    cmd.extend(['-filter_complex', full_filter])
                     cmd.extend(['-map', '[outv]'])
                     
                     # Video codec settings
@@ -562,7 +727,7 @@ class VideoMerger:
                     # Audio handling with proper normalization
                     if audio_handling == 'remove':
                         cmd.extend(['-an'])  # No audio
-                    elif audio_handling == 'keep_first' and len(segment_files) > 0:
+                    elif not concat_audio:
                         # Use only the first video's audio
                         cmd.extend([
                             '-map', '0:a:0',
@@ -572,24 +737,6 @@ class VideoMerger:
                             '-b:a', '192k'
                         ])
                     else:
-                        # Properly handle audio concatenation with normalization
-                        audio_filter = []
-                        audio_inputs = []
-                        
-                        # Build audio normalization filters
-                        for i in range(len(segment_files)):
-                            # Normalize each audio stream to consistent format
-                            audio_filter.append(f"[{i}:a]aformat=sample_rates=44100:channel_layouts=stereo,volume=1.0[a{i}];")
-                            audio_inputs.append(f"[a{i}]")
-                        
-                        # Concatenate normalized audio streams
-                        audio_filter.extend(audio_inputs)
-                        audio_filter.append(f"concat=n={len(segment_files)}:v=0:a=1[outa]")
-                        
-                        # Update filter complex to include audio processing
-                        current_filter = cmd[cmd.index('-filter_complex') + 1]
-                        cmd[cmd.index('-filter_complex') + 1] = current_filter + ''.join(audio_filter)
-                        
                         cmd.extend(['-map', '[outa]'])
                         cmd.extend([
                             '-c:a', output_format['audio_codec'],
@@ -602,7 +749,7 @@ class VideoMerger:
                     print(f"Running FFmpeg command (Method 2): {' '.join(cmd)}")
                     
                     # Run FFmpeg command
-                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
+                    result = _run_encode(cmd, timeout=1800)
                     
                     if result.returncode != 0:
                         print(f"FFmpeg merge error (Method 2): {result.stderr}")
@@ -615,7 +762,8 @@ class VideoMerger:
                     
                     # Method 3: Simple and reliable approach with explicit audio handling
                     try:
-                        return self._merge_video_segments_simple(segment_files, output_path, output_format, audio_handling)
+                        return self._merge_video_segments_simple(segment_files, output_path, output_format, audio_handling,
+                                                                 task, total_duration)
                     except Exception as e3:
                         print(f"Method 3 failed: {e3}")
                         return False
@@ -625,7 +773,8 @@ class VideoMerger:
             return False
     
     def _merge_video_segments_simple(self, segment_files: List[str], output_path: str, 
-                                   output_format: Dict[str, Any], audio_handling: str) -> bool:
+                                   output_format: Dict[str, Any], audio_handling: str,
+                                   task: Optional[VideoMergeTask] = None, total_duration: float = 0.0) -> bool:
         """Simple and reliable video merging method with proper audio handling"""
         try:
             print(f"Using simple merge method for {len(segment_files)} segments")
@@ -667,20 +816,55 @@ class VideoMerger:
                         '-af', 'aresample=async=1000'  # Audio resampling for sync
                     ])
                 
+                # Report progress as key=value lines on stdout
+                cmd.extend(['-progress', 'pipe:1', '-nostats'])
+                
                 # Output file
                 cmd.append(output_path)
                 
                 print(f"Running simple FFmpeg command: {' '.join(cmd)}")
                 
-                # Run FFmpeg command
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
+                # Run FFmpeg command, tracking encoded time for progress
+                total_us = int(total_duration * 1000000)
+                log_lines = []
+                
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                
+                # Enforce the deadline independently of output: FFmpeg may stall without printing
+                timed_out = threading.Event()
+                
+                def kill_on_timeout():
+                    timed_out.set()
+                    process.kill()
+                
+                watchdog = threading.Timer(1800, kill_on_timeout)
+                watchdog.daemon = True
+                watchdog.start()
+                try:
+                    for line in process.stdout:
+                        key, sep, value = line.strip().partition('=')
+                        if not sep or ' ' in key:
+                            log_lines.append(line)
+                        elif key == 'out_time_us' and task is not None and total_us > 0 and value.isdigit():
+                            progress = 50 + min(49, int(49 * int(value) / total_us))  # 50-99% for merging
+                            if progress != task.progress_percentage:
+                                task.progress_percentage = progress
+                                self.storage.save_merge_task(task)
+                finally:
+                    watchdog.cancel()
+                    process.stdout.close()
+                    returncode = process.wait()
+                
+                if timed_out.is_set():
+                    print("FFmpeg processing timeout")
+                    return False
                 
-                if result.returncode != 0:
-                    print(f"Simple FFmpeg merge error: {result.stderr}")
+                if returncode != 0:
+                    print(f"Simple FFmpeg merge error: {''.join(log_lines)}")
                     return False
                 
                 # Verify output
-                if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+                if not _nonempty(output_path):
                     print("Output file is empty or does not exist")
                     return False
                 
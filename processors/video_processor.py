@@ -4,23 +4,37 @@ Video processor for watermark removal
 
 import os
 import sys
+import base64
 import cv2
 import numpy as np
 import tempfile
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple, Optional, Any
 
 # 确保可以导入 models 和 config 模块
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from config import get_current_config
+from core.utils import check_ffmpeg_availability
+from core.video_io import EncoderError, FFmpegFrameReader, FFmpegFrameWriter, get_hw_codecs, open_video_capture
 from models.task import VideoWatermarkTask
 from models.storage import TaskStorage
 
+# Frames are inpainted in parallel across Python threads, so keep OpenCV itself single-threaded.
+# The thread count is process-wide and tasks run concurrently: set it once here, never per task
+cv2.setNumThreads(1)
+
 class VideoProcessor:
     """Video processor for watermark removal"""
     
+    # Largest forward gap between sample frames that is skipped by grabbing instead of seeking
+    MAX_GRAB_SKIP = 30
+    
+    # Minimum seconds between progress writes to task storage during frame processing
+    PROGRESS_SAVE_INTERVAL = 1.0
+    
     def __init__(self):
         """Initialize processor"""
         current_config = get_current_config()
@@ -74,8 +88,11 @@ class VideoProcessor:
     def get_sample_frames(self, video_path: str, sample_count: int = 10) -> List[Tuple[int, str]]:
         """Get sample frames for selection"""
         try:
-            info = self.extract_video_info(video_path)
-            frame_count = info['frame_count']
+            # Open once and read metadata from the same handle used for sampling
+            cap = cv2.VideoCapture(video_path)
+            if not cap.isOpened():
+                raise Exception("Cannot open video file")
+            frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
             
             # Calculate sampling interval
             if frame_count <= sample_count:
@@ -85,16 +102,24 @@ class VideoProcessor:
                 frame_numbers = [i * step for i in range(sample_count)]
             
             frames_data = []
-            cap = cv2.VideoCapture(video_path)
-            
-            for frame_num in frame_numbers:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+            jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, config.FRAME_QUALITY]
+            
+            # Visit frames in order; short forward gaps are skipped with grab(), which is
+            # much cheaper than a keyframe-anchored seek
+            position = 0
+            for frame_num in sorted(frame_numbers):
+                if 0 <= frame_num - position <= self.MAX_GRAB_SKIP:
+                    while position < frame_num and cap.grab():
+                        position += 1
+                if position != frame_num:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+                
                 ret, frame = cap.read()
+                position = frame_num + 1
                 if ret:
                     # Convert frame to base64 encoded JPEG
-                    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, config.FRAME_QUALITY])
-                    import base64
-                    frame_base64 = base64.b64encode(buffer).decode('utf-8')
+                    _, buffer = cv2.imencode('.jpg', frame, jpeg_params)
+                    frame_base64 = base64.b64encode(memoryview(buffer)).decode('ascii')
                     frames_data.append((frame_num, f"data:image/jpeg;base64,{frame_base64}"))
             
             cap.release()
@@ -104,8 +129,9 @@ class VideoProcessor:
             print(f"Failed to get sample frames: {e}")
             return []
     
-    def process_video_remove_watermark(self, task: VideoWatermarkTask, regions: List[Dict[str, Any]]) -> bool:
-        """Process video to remove watermark"""
+    def process_video_remove_watermark(self, task: VideoWatermarkTask, regions: List[Dict[str, Any]],
+                                       encoder: Optional[str] = None) -> bool:
+        """Process video to remove watermark (encoder defaults to the detected hardware encoder or libx264)"""
         start_time = time.time()
         
         try:
@@ -121,8 +147,8 @@ class VideoProcessor:
             temp_video_path = os.path.join(self.temp_dir, f"temp_{task.task_uuid}.mp4")
             output_video_path = os.path.join(self.temp_dir, f"output_{task.task_uuid}.mp4")
             
-            # Open video
-            cap = cv2.VideoCapture(task.original_file_path)
+            # Open video with multi-threaded decoding
+            cap = open_video_capture(task.original_file_path)
             if not cap.isOpened():
                 raise Exception("Cannot open original video file")
             
@@ -132,9 +158,21 @@ class VideoProcessor:
             height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
             
-            # Create video writer
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            out = cv2.VideoWriter(temp_video_path, fourcc, fps, (width, height))
+            # Use FFmpeg pipes for hardware-accelerated decode and multi-threaded encode when available
+            ffmpeg_available = check_ffmpeg_availability()
+            hwaccel, hw_encoder = get_hw_codecs() if ffmpeg_available else (None, None)
+            if hwaccel:
+                cap.release()
+                cap = FFmpegFrameReader(task.original_file_path, width, height, hwaccel)
+            
+            # Create video writer; the FFmpeg writer muxes the original audio in the same pass,
+            # so the output is written directly without a temp file and a second remux
+            if ffmpeg_available:
+                out = FFmpegFrameWriter(output_video_path, width, height, fps, encoder or hw_encoder or 'libx264',
+                                        audio_path=task.original_file_path)
+            else:
+                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                out = cv2.VideoWriter(temp_video_path, fourcc, fps, (width, height))
             
             # Create static mask
             mask = np.zeros((height, width), dtype=np.uint8)
@@ -147,50 +185,82 @@ class VideoProcessor:
             # Process frames in batches
             processed_frames = 0
             batch_size = config.BATCH_SIZE
-            batch_frames = []
-            
-            while True:
-                # Check timeout
-                if time.time() - start_time > config.MAX_PROCESSING_TIME:
-                    self.storage.add_log(task.task_uuid, 'warning', 'Processing timeout, using fast mode', 'timeout')
-                    cap.release()
-                    out.release()
-                    return self._process_remaining_frames_fast(task, regions, processed_frames, frame_count)
-                
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                
-                batch_frames.append(frame)
-                
-                # Process batch
-                if len(batch_frames) >= batch_size or processed_frames + len(batch_frames) >= frame_count:
-                    for frame in batch_frames:
-                        # Use inpaint algorithm to remove watermark
-                        inpainted_frame = cv2.inpaint(frame, mask, 3, cv2.INPAINT_NS)
-                        out.write(inpainted_frame)
-                    
-                    processed_frames += len(batch_frames)
-                    batch_frames = []
+            # Decode straight into a preallocated batch buffer instead of appending to a list
+            batch_buffer = np.empty((batch_size, height, width, 3), dtype=np.uint8)
+            batch_count = 0
+            
+            # Frames are independent and the mask is read-only, so inpaint each batch
+            # across a thread pool (cv2.inpaint releases the GIL)
+            def inpaint(frame):
+                # TELEA with radius 1 is much cheaper than NS for static logos;
+                # fall back to NS (radius 3) if it fails
+                try:
+                    return cv2.inpaint(frame, mask, 1, cv2.INPAINT_TELEA)
+                except cv2.error:
+                    return cv2.inpaint(frame, mask, 3, cv2.INPAINT_NS)
+            
+            workers = os.cpu_count() or 1
+            
+            # Bind hot-loop lookups to locals once instead of resolving them per frame
+            read, write, now = cap.read, out.write, time.time
+            max_processing_time = config.MAX_PROCESSING_TIME
+            last_save = last_log = now()
+            
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                while True:
+                    # Check timeout
+                    if now() - start_time > max_processing_time:
+                        self.storage.add_log(task.task_uuid, 'warning', 'Processing timeout, using fast mode', 'timeout')
+                        cap.release()
+                        out.release()
+                        return self._process_remaining_frames_fast(task, regions, processed_frames, frame_count)
                     
-                    # Update progress
-                    progress = min(int((processed_frames / frame_count) * 80), 80)  # 80% for video processing
-                    if progress != task.progress_percentage:
-                        task.progress_percentage = progress
-                        self.storage.save_task(task)
+                    slot = batch_buffer[batch_count]
+                    ret, frame = read(slot)
+                    if not ret:
+                        break
+                    if frame is not slot:
+                        # The reader allocated its own frame (e.g. size mismatch); copy it in
+                        slot[...] = frame
+                    batch_count += 1
                     
-                    # Log progress every 100 frames
-                    if processed_frames % 100 == 0:
-                        self.storage.add_log(task.task_uuid, 'info', 
-                                           f'Processed {processed_frames}/{frame_count} frames', 'processing_frames')
+                    # Process batch
+                    if batch_count >= batch_size or processed_frames + batch_count >= frame_count:
+                        # Preserve frame order
+                        for inpainted_frame in executor.map(inpaint, batch_buffer[:batch_count]):
+                            write(inpainted_frame)
+                        
+                        processed_frames += batch_count
+                        batch_count = 0
+                        
+                        # Update progress, persisting at most once per interval (and at the end of this stage)
+                        progress = min(int((processed_frames / frame_count) * 80), 80)  # 80% for video processing
+                        if progress != task.progress_percentage:
+                            task.progress_percentage = progress
+                            if now() - last_save >= self.PROGRESS_SAVE_INTERVAL or progress == 80:
+                                self.storage.save_task(task)
+                                last_save = now()
+                        
+                        # Log progress, throttled the same way
+                        if now() - last_log >= self.PROGRESS_SAVE_INTERVAL:
+                            self.storage.add_log(task.task_uuid, 'info', 
+                                               f'Processed {processed_frames}/{frame_count} frames', 'processing_frames')
+                            last_log = now()
             
             cap.release()
-            out.release()
+            # The FFmpeg writer reports encoder failure (cv2.VideoWriter returns None)
+            if out.release() is False:
+                raise EncoderError(out.encoder, f"FFmpeg failed to encode output video with {out.encoder}")
             
             self.storage.add_log(task.task_uuid, 'info', 'Video frame processing completed', 'frames_complete')
             
-            # Merge audio
-            success = self._merge_audio_with_ffmpeg(task.original_file_path, temp_video_path, output_video_path)
+            # Merge audio (already muxed when encoding through FFmpeg)
+            if ffmpeg_available:
+                success = os.path.exists(output_video_path) and os.path.getsize(output_video_path) > 0
+                if not success:
+                    raise Exception("FFmpeg failed to write output video")
+            else:
+                success = self._merge_audio_with_ffmpeg(task.original_file_path, temp_video_path, output_video_path)
             
             if success:
                 task.processed_file_path = output_video_path
@@ -220,6 +290,12 @@ class VideoProcessor:
             return True
             
         except Exception as e:
+            # Hardware encoders can fail mid-run (e.g. GPU session limit); redo the pass with libx264
+            if isinstance(e, EncoderError) and e.encoder != 'libx264':
+                cap.release()
+                self.storage.add_log(task.task_uuid, 'warning', f'{e}, retrying with libx264', 'encoder_fallback')
+                return self.process_video_remove_watermark(task, regions, encoder='libx264')
+            
             error_msg = f"Video processing failed: {str(e)}"
             task.status = 'failed'
             task.error_message = error_msg
@@ -231,10 +307,8 @@ class VideoProcessor:
     def _merge_audio_with_ffmpeg(self, original_video: str, processed_video: str, output_video: str) -> bool:
         """Merge audio using FFmpeg"""
         try:
-            # Check if FFmpeg is installed
-            result = subprocess.run(['ffmpeg', '-version'], 
-                                  capture_output=True, text=True, timeout=10)
-            if result.returncode != 0:
+            # Check if FFmpeg is installed (probed once per process)
+            if not check_ffmpeg_availability():
                 print("FFmpeg not installed, skipping audio merge")
                 return False
             
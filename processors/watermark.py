@@ -3,14 +3,87 @@
 异步处理视频水印去除任务
 """
 import os
+import heapq
+import queue
+import threading
 import cv2
 import numpy as np
 from typing import Dict, Callable, Optional
 import logging
 from core.utils import check_ffmpeg_availability
+from core.video_io import (EncoderError, FFmpegFrameReader, FFmpegFrameWriter, get_hw_codecs,
+                           open_video_capture, probe_video_packets)
 
 logger = logging.getLogger(__name__)
 
+# 逐帧修复在多个Python线程间并行，OpenCV内部保持单线程以免过度订阅。
+# 线程数是进程级设置且多个任务并发运行，因此只在导入时设置一次，不在每个任务中修改和恢复
+cv2.setNumThreads(1)
+
+class _InpaintPatchCache:
+    """
+    静态背景下复用已修复的水印区域补丁
+    
+    水印掩码在所有帧中相同，背景基本不变时逐帧inpaint会重复相同的计算。
+    每帧比较水印区域外围一圈像素与参考帧的差异：差异小于阈值时直接粘贴参考帧的修复结果，
+    否则（或距上次修复超过refresh_interval帧）重新inpaint并更新参考帧
+    """
+    
+    def __init__(self, inpaint_fn: Callable[[np.ndarray], np.ndarray], rects: np.ndarray,
+                 width: int, height: int, collar: int = 8, threshold: float = 3.0,
+                 refresh_interval: int = 30):
+        self.inpaint_fn = inpaint_fn
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        
+        # 每个区域: (补丁切片, 外围区域切片, 外围环形掩码)
+        self.regions = []
+        for x1, y1, x2, y2 in rects:
+            patch = (slice(y1, y2 + 1), slice(x1, x2 + 1))
+            cx1, cy1 = max(0, x1 - collar), max(0, y1 - collar)
+            cx2, cy2 = min(width, x2 + 1 + collar), min(height, y2 + 1 + collar)
+            ring = np.full((cy2 - cy1, cx2 - cx1), 255, dtype=np.uint8)
+            ring[y1 - cy1:y2 + 1 - cy1, x1 - cx1:x2 + 1 - cx1] = 0
+            self.regions.append((patch, (slice(cy1, cy2), slice(cx1, cx2)), ring))
+        
+        self._lock = threading.Lock()
+        self._reference = None  # [(外围像素, 修复后补丁), ...]
+        self._frames_since_refresh = 0
+    
+    def apply(self, frame: np.ndarray) -> np.ndarray:
+        """对单帧去水印，优先复用缓存的补丁"""
+        if not self.regions:
+            return self.inpaint_fn(frame)
+        
+        with self._lock:
+            reference = self._reference
+            stale = self._frames_since_refresh >= self.refresh_interval
+        
+        if reference is not None and not stale and self._matches(frame, reference):
+            for (patch, _, _), (_, patch_pixels) in zip(self.regions, reference):
+                frame[patch] = patch_pixels
+            with self._lock:
+                self._frames_since_refresh += 1
+            return frame
+        
+        # inpaint_fn可能原地修改帧，外围像素需在修复前复制
+        collars = [frame[box].copy() for _, box, _ in self.regions]
+        result = self.inpaint_fn(frame)
+        reference = [(collar_pixels, result[patch].copy())
+                     for collar_pixels, (patch, _, _) in zip(collars, self.regions)]
+        with self._lock:
+            self._reference = reference
+            self._frames_since_refresh = 0
+        return result
+    
+    def _matches(self, frame: np.ndarray, reference: list) -> bool:
+        """水印外围像素与参考帧的平均差异是否低于阈值"""
+        for (_, box, ring), (collar_pixels, _) in zip(self.regions, reference):
+            diff = cv2.absdiff(frame[box], collar_pixels)
+            if max(cv2.mean(diff, mask=ring)[:3]) > self.threshold:
+                return False
+        return True
+
 class WatermarkProcessor:
     """水印去除处理器"""
     
@@ -28,9 +101,6 @@ class WatermarkProcessor:
         Returns:
             str: 输出文件路径
         """
-        import subprocess
-        import tempfile
-        
         task_id = task.get('task_id', 'unknown')
         sid = task.get('sid', 'unknown')
         
@@ -69,20 +139,26 @@ class WatermarkProcessor:
             
             progress_callback(10, "开始处理视频...")
             
-            # 创建临时文件用于处理
-            temp_video_path = os.path.join(tempfile.gettempdir(), f"temp_video_{task.get('task_id', 'unknown')}.mp4")
-            
-            # 使用OpenCV处理视频帧
-            self._process_video_frames(input_path, temp_video_path, regions, progress_callback)
-            
-            progress_callback(80, "合并音频...")
-            
-            # 使用FFmpeg合并音频
-            self._merge_audio_with_ffmpeg(input_path, temp_video_path, output_path)
-            
-            # 清理临时文件
-            if os.path.exists(temp_video_path):
-                os.remove(temp_video_path)
+            # 默认使用FFmpeg delogo滤镜一次完成解码、去水印、编码和音频复制；
+            # 指定algorithm为inpaint或delogo失败时使用OpenCV逐帧修复
+            # 指定time_ranges时只对水印出现的时间段做delogo，其余部分直接流复制
+            algorithm = config.get('algorithm', 'delogo')
+            time_ranges = config.get('time_ranges')
+            if (algorithm == 'delogo' and time_ranges and
+                    self._remove_watermark_in_time_ranges(input_path, output_path, regions, time_ranges, progress_callback)):
+                logger.info(f"[WATERMARK_PROCESS] Processed time ranges with FFmpeg delogo - task_id: {task_id}, session_id: {sid}")
+            elif algorithm == 'delogo' and self._remove_watermark_with_delogo(input_path, output_path, regions, progress_callback):
+                logger.info(f"[WATERMARK_PROCESS] Processed with FFmpeg delogo - task_id: {task_id}, session_id: {sid}")
+            else:
+                # 使用OpenCV处理视频帧，FFmpeg编码时在同一次编码中混入原始音频
+                try:
+                    self._process_video_frames(input_path, output_path, regions, progress_callback)
+                except EncoderError as e:
+                    # 硬件编码器失败（如并发会话数超限）时改用软件编码重新处理
+                    if e.encoder == 'libx264':
+                        raise
+                    logger.warning(f"[WATERMARK_PROCESS] {e}, retrying with libx264 - task_id: {task_id}, session_id: {sid}")
+                    self._process_video_frames(input_path, output_path, regions, progress_callback, encoder='libx264')
             
             # 验证输出文件
             if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
@@ -96,19 +172,334 @@ class WatermarkProcessor:
             
         except Exception as e:
             logger.error(f"[WATERMARK_PROCESS] Watermark removal failed - task_id: {task_id}, session_id: {sid}, error: {e}")
-            # 清理可能的临时和输出文件
-            for path in [locals().get('temp_video_path'), locals().get('output_path')]:
-                if path and os.path.exists(path):
-                    try:
-                        os.remove(path)
-                    except:
-                        pass
+            # 清理可能的输出文件
+            path = locals().get('output_path')
+            if path and os.path.exists(path):
+                try:
+                    os.remove(path)
+                except:
+                    pass
             raise
     
-    def _process_video_frames(self, input_path: str, output_path: str, regions: list, progress_callback: Callable):
-        """处理视频帧"""
-        # 打开视频文件
+    def _remove_watermark_with_delogo(self, input_path: str, output_path: str, regions: list,
+                                      progress_callback: Callable) -> bool:
+        """
+        使用FFmpeg delogo滤镜去除固定矩形水印
+        
+        在FFmpeg的解码/编码流程内完成多线程滤镜处理，无需逐帧经过Python，
+        也无需单独的音频合并步骤
+        
+        Returns:
+            bool: 处理成功返回True，FFmpeg不可用或处理失败返回False
+        """
+        import subprocess
+        
+        if not check_ffmpeg_availability():
+            logger.warning("FFmpeg not available, falling back to OpenCV inpainting")
+            return False
+        
         cap = cv2.VideoCapture(input_path)
+        if not cap.isOpened():
+            raise ValueError("Cannot open video file")
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+        
+        delogo_filter = self._build_delogo_filter(regions, width, height)
+        if not delogo_filter:
+            logger.warning("No valid regions for delogo, falling back to OpenCV inpainting")
+            return False
+        
+        cmd = [
+            'ffmpeg', '-y',
+            '-i', input_path,
+            '-vf', delogo_filter,
+            '-map', '0:v:0',
+            '-map', '0:a?',
+            '-c:v', 'libx264',
+            '-preset', 'medium',
+            '-crf', '23',
+            '-pix_fmt', 'yuv420p',
+            '-c:a', 'copy',
+            '-threads', str(os.cpu_count() or 1),
+            output_path
+        ]
+        
+        progress_callback(20, f"使用FFmpeg delogo处理: {width}x{height}")
+        logger.info(f"Running delogo: {' '.join(cmd)}")
+        
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
+        except subprocess.TimeoutExpired as e:
+            logger.warning(f"FFmpeg delogo timeout, falling back to OpenCV inpainting: {e}")
+            return False
+        
+        if result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            logger.warning(f"FFmpeg delogo failed, falling back to OpenCV inpainting: {result.stderr}")
+            return False
+        
+        progress_callback(80, "FFmpeg delogo处理完成")
+        return True
+    
+    def _remove_watermark_in_time_ranges(self, input_path: str, output_path: str, regions: list,
+                                         time_ranges: list, progress_callback: Callable) -> bool:
+        """
+        只对水印出现的时间段使用delogo重新编码，其余时间段直接流复制后拼接
+        
+        流复制只能从关键帧开始，因此时间段会向外扩展到关键帧边界。
+        重新编码的片段与原视频编码相同（H.264/yuv420p），各片段以MPEG-TS格式
+        携带各自的参数集，拼接后与原始音频封装为avc3（码流内参数集）的MP4
+        
+        Args:
+            time_ranges: 水印时间段列表，每项为{'start': 秒, 'end': 秒或None(到结尾)}
+            
+        Returns:
+            bool: 处理成功返回True；FFmpeg不可用、源编码不兼容或处理失败返回False
+        """
+        import subprocess
+        import tempfile
+        
+        if not check_ffmpeg_availability():
+            return False
+        
+        stream = self._probe_video_stream(input_path)
+        if not stream or stream.get('codec_name') != 'h264' or stream.get('pix_fmt') != 'yuv420p':
+            logger.info("Source is not H.264/yuv420p, cannot stream-copy unaffected segments")
+            return False
+        
+        width, height, duration = stream['width'], stream['height'], stream['duration']
+        delogo_filter = self._build_delogo_filter(regions, width, height)
+        # 关键帧pts_time是绝对时间戳，换算为相对文件起始时间（MPEG-TS等起始时间不为0）的时间，
+        # 并记录每个关键帧的包序号用于按帧切分
+        keyframe_index = {
+            pts - stream['start_time']: index
+            for index, (pts, key) in enumerate(probe_video_packets(input_path)) if key and pts is not None
+        }
+        keyframes = sorted(keyframe_index)
+        if not delogo_filter or not keyframes or duration <= 0:
+            return False
+        
+        try:
+            segments = self._plan_time_segments(time_ranges, keyframes, duration)
+        except ValueError as e:
+            logger.warning(f"Invalid time ranges: {e}")
+            return False
+        if not any(delogo for _, _, delogo in segments) or all(delogo for _, _, delogo in segments):
+            # 没有需要处理或没有可复制的片段，交给整段处理
+            return False
+        
+        progress_callback(20, f"按时间段处理: {len(segments)}个片段")
+        
+        with tempfile.TemporaryDirectory() as work_dir:
+            # 一次流复制按关键帧的包序号切出所有片段。-ss/-t流复制按DTS截断，有B帧时会把
+            # 下一个关键帧之后的帧带入片段末尾；按时间切分的时间零点又与-ss不同，因此按帧序号切分
+            pattern = os.path.join(work_dir, 'part_%03d.ts')
+            cmd = [
+                'ffmpeg', '-y', '-v', 'error', '-i', input_path,
+                '-map', '0:v:0', '-c:v', 'copy', '-bsf:v', 'h264_mp4toannexb',
+                '-f', 'segment', '-segment_format', 'mpegts',
+                '-segment_frames', ','.join(str(keyframe_index[start]) for start, _, _ in segments[1:]),
+                pattern
+            ]
+            try:
+                result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
+            except subprocess.TimeoutExpired as e:
+                logger.warning(f"FFmpeg split timeout: {e}")
+                return False
+            parts = [pattern % index for index in range(len(segments))]
+            if (result.returncode != 0 or not all(os.path.exists(path) for path in parts)
+                    or os.path.exists(pattern % len(segments))):
+                logger.warning(f"FFmpeg split did not match keyframe plan: {result.stderr}")
+                return False
+            
+            progress_callback(30, "片段切分完成")
+            
+            # 只重新编码水印所在的片段
+            delogo_parts = [index for index, (_, _, delogo) in enumerate(segments) if delogo]
+            for done, index in enumerate(delogo_parts, 1):
+                encoded_path = os.path.join(work_dir, f"delogo_{index:03d}.ts")
+                cmd = [
+                    'ffmpeg', '-y', '-v', 'error', '-i', parts[index],
+                    '-vf', delogo_filter,
+                    '-c:v', 'libx264',
+                    '-preset', 'medium',
+                    '-crf', '23',
+                    '-pix_fmt', 'yuv420p',
+                    '-threads', str(os.cpu_count() or 1),
+                    '-bsf:v', 'h264_mp4toannexb', '-f', 'mpegts', encoded_path
+                ]
+                try:
+                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=1800)
+                except subprocess.TimeoutExpired as e:
+                    logger.warning(f"FFmpeg segment timeout: {e}")
+                    return False
+                if result.returncode != 0:
+                    logger.warning(f"FFmpeg segment failed: {result.stderr}")
+                    return False
+                
+                parts[index] = encoded_path
+                progress_callback(30 + int(50 * done / len(delogo_parts)),
+                                  f"去水印片段 {done}/{len(delogo_parts)} 完成")
+            
+            list_path = os.path.join(work_dir, 'parts.txt')
+            with open(list_path, 'w') as f:
+                f.writelines(f"file '{path}'\n" for path in parts)
+            
+            # 拼接视频片段，并复制原始音频。源片段与libx264片段的SPS/PPS不同，
+            # 使用avc3让解码器读取码流内的参数集，而不是只信任avcC中第一个片段的参数集
+            cmd = [
+                'ffmpeg', '-y', '-v', 'error',
+                '-f', 'concat', '-safe', '0', '-i', list_path,
+                '-i', input_path,
+                '-map', '0:v:0',
+                '-map', '1:a?',
+                '-c', 'copy',
+                '-tag:v', 'avc3',
+                output_path
+            ]
+            try:
+                result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+            except subprocess.TimeoutExpired as e:
+                logger.warning(f"FFmpeg concat timeout: {e}")
+                return False
+        
+        if result.returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            logger.warning(f"FFmpeg concat failed: {result.stderr}")
+            return False
+        
+        return True
+    
+    @staticmethod
+    def _plan_time_segments(time_ranges: list, keyframes: list, duration: float) -> list:
+        """
+        将水印时间段扩展到关键帧边界，并与中间的流复制片段组成完整时间线
+        
+        Returns:
+            list: [(开始秒, 结束秒, 是否需要delogo), ...]，按时间顺序覆盖整个视频
+            
+        Raises:
+            ValueError: 时间段列表格式错误，或start/end不是有限数值
+        """
+        import bisect
+        import math
+        
+        def seconds(value, name):
+            # bool可以转换为float，但不是合法的时间
+            try:
+                result = float(value) if not isinstance(value, bool) else math.nan
+            except (TypeError, ValueError):
+                result = math.nan
+            if not math.isfinite(result):
+                raise ValueError(f"{name} must be a finite number, got {value!r}")
+            return result
+        
+        if not isinstance(time_ranges, (list, tuple)):
+            raise ValueError(f"time ranges must be a list, got {time_ranges!r}")
+        
+        spans = []
+        for time_range in time_ranges:
+            if not isinstance(time_range, dict):
+                raise ValueError(f"time range must be a dict, got {time_range!r}")
+            
+            start = time_range.get('start')
+            start = 0.0 if start is None else max(0.0, seconds(start, 'start'))
+            end = time_range.get('end')
+            end = duration if end is None else min(seconds(end, 'end'), duration)
+            if end <= start:
+                continue
+            
+            # 开始取不晚于start的关键帧，结束取不早于end的关键帧
+            i = bisect.bisect_right(keyframes, start)
+            start = keyframes[i - 1] if i > 0 else 0.0
+            j = bisect.bisect_left(keyframes, end)
+            end = keyframes[j] if j < len(keyframes) else duration
+            spans.append([start, end])
+        
+        # 合并重叠的时间段
+        merged = []
+        for span in sorted(spans):
+            if merged and span[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], span[1])
+            else:
+                merged.append(span)
+        
+        segments = []
+        cursor = 0.0
+        for start, end in merged:
+            if start > cursor:
+                segments.append((cursor, start, False))
+            segments.append((start, end, True))
+            cursor = end
+        if cursor < duration:
+            segments.append((cursor, duration, False))
+        
+        return segments
+    
+    def _probe_video_stream(self, input_path: str) -> Optional[dict]:
+        """使用ffprobe读取第一条视频流的编码、像素格式、尺寸，以及文件时长和起始时间"""
+        import json
+        import subprocess
+        
+        cmd = [
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=codec_name,pix_fmt,width,height:format=duration,start_time',
+            '-of', 'json',
+            input_path
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+            if result.returncode != 0:
+                return None
+            info = json.loads(result.stdout)
+            stream = info['streams'][0]
+            return {
+                'codec_name': stream.get('codec_name'),
+                'pix_fmt': stream.get('pix_fmt'),
+                'width': int(stream['width']),
+                'height': int(stream['height']),
+                'duration': float(info.get('format', {}).get('duration') or 0),
+                # 输入端-ss以容器（而非视频流）的起始时间为零点
+                'start_time': float(info.get('format', {}).get('start_time') or 0)
+            }
+        except (subprocess.TimeoutExpired, FileNotFoundError, OSError, ValueError, KeyError, IndexError) as e:
+            logger.warning(f"ffprobe failed: {e}")
+            return None
+    
+    def _build_delogo_filter(self, regions: list, video_width: int, video_height: int) -> str:
+        """
+        构建delogo滤镜链
+        
+        delogo要求水印区域不能接触画面边缘，因此区域会被收缩到距边缘至少1像素
+        
+        Returns:
+            str: 逗号分隔的delogo滤镜，没有有效区域时返回空字符串
+        """
+        filters = []
+        for region in self.validate_regions(regions, video_width, video_height):
+            x = max(1, region['x'])
+            y = max(1, region['y'])
+            width = min(region['x'] + region['width'], video_width - 1) - x
+            height = min(region['y'] + region['height'], video_height - 1) - y
+            
+            if width > 0 and height > 0:
+                filters.append(f"delogo=x={x}:y={y}:w={width}:h={height}")
+        
+        return ','.join(filters)
+    
+    def _process_video_frames(self, input_path: str, output_path: str, regions: list, progress_callback: Callable,
+                              encoder: Optional[str] = None):
+        """
+        处理视频帧
+        
+        Args:
+            encoder: FFmpeg编码器，默认使用检测到的硬件编码器或libx264
+            
+        Raises:
+            EncoderError: FFmpeg编码失败
+        """
+        # 打开视频文件（多线程解码）
+        cap = open_video_capture(input_path)
         if not cap.isOpened():
             raise ValueError("Cannot open video file")
         
@@ -121,179 +512,261 @@ class WatermarkProcessor:
             
             progress_callback(20, f"视频信息: {width}x{height}, {fps:.1f}fps, {total_frames}帧")
             
-            # 设置视频编码器 - 使用更好的编码器
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+            # 有硬件加速时通过FFmpeg管道解码；FFmpeg可用时通过管道多线程编码，否则使用OpenCV
+            ffmpeg_available = check_ffmpeg_availability()
+            hwaccel, hw_encoder = get_hw_codecs() if ffmpeg_available else (None, None)
+            if hwaccel:
+                cap.release()
+                cap = FFmpegFrameReader(input_path, width, height, hwaccel)
+            
+            if ffmpeg_available:
+                # 原始文件同时作为音频输入，省去编码后再次读取整个视频合并音频
+                out = FFmpegFrameWriter(output_path, width, height, fps, encoder or hw_encoder or 'libx264',
+                                        audio_path=input_path)
+            else:
+                # FFmpeg不可用时无法合并音频，直接输出无音频视频
+                # 设置视频编码器 - 使用更好的编码器
+                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
             
             if not out.isOpened():
                 raise ValueError("Cannot create output video file")
             
-            frame_count = 0
+            workers = os.cpu_count() or 1
+            
+            # 区域坐标和掩码在整个视频中不变，只在循环外计算一次
+            rects = self._regions_to_rects(regions, width, height)
+            mask = self._build_mask(rects, width, height)
+            roi = self._inpaint_roi(rects, width, height)
+            
+            # 背景静止时复用参考帧的修复补丁，避免每帧重复inpaint
+            patch_cache = _InpaintPatchCache(lambda frame: self._inpaint_frame(frame, mask, rects, roi),
+                                             rects, width, height)
+            
+            # 解码、去水印、编码三级流水线：解码线程 -> 去水印线程组 -> 当前线程编码写入
+            # cap.read / cv2.inpaint / out.write 都会释放GIL，线程即可实现并行
+            raw_q = queue.Queue(maxsize=max(16, workers * 2))
+            done_q = queue.Queue(maxsize=max(16, workers * 2))
+            stop = threading.Event()
+            errors = []
+            
+            def put(q, item) -> bool:
+                """放入队列，流水线停止时放弃"""
+                while not stop.is_set():
+                    try:
+                        q.put(item, timeout=0.1)
+                        return True
+                    except queue.Full:
+                        continue
+                return False
+            
+            # 热循环中的方法预先绑定为局部变量，避免每帧重复属性查找
+            def decode():
+                read, stopped = cap.read, stop.is_set
+                try:
+                    index = 0
+                    while not stopped():
+                        ret, frame = read()
+                        if not ret:
+                            break
+                        if not put(raw_q, (index, frame)):
+                            return
+                        index += 1
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+                finally:
+                    # 每个去水印线程一个结束标记
+                    for _ in range(workers):
+                        if not put(raw_q, None):
+                            break
+            
+            def inpaint():
+                get, apply, stopped = raw_q.get, patch_cache.apply, stop.is_set
+                try:
+                    while not stopped():
+                        try:
+                            item = get(timeout=0.1)
+                        except queue.Empty:
+                            continue
+                        if item is None:
+                            break
+                        index, frame = item
+                        if not put(done_q, (index, apply(frame))):
+                            break
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+                finally:
+                    done_q.put(None)
+            
+            threads = [threading.Thread(target=decode, daemon=True)]
+            threads += [threading.Thread(target=inpaint, daemon=True) for _ in range(workers)]
+            for thread in threads:
+                thread.start()
             
             try:
-                while True:
-                    ret, frame = cap.read()
-                    if not ret:
-                        break
-                    
-                    # 处理水印区域
-                    processed_frame = self._remove_watermark_from_frame(frame, regions)
-                    
-                    # 写入输出视频
-                    out.write(processed_frame)
-                    
-                    frame_count += 1
+                # 按帧序号重新排序后写入输出视频
+                pending = []
+                next_index = 0
+                finished_workers = 0
+                get, write = done_q.get, out.write
+                heappush, heappop = heapq.heappush, heapq.heappop
+                
+                while finished_workers < workers:
+                    item = get()
+                    if item is None:
+                        finished_workers += 1
+                        continue
                     
-                    # 更新进度
-                    if frame_count % 30 == 0:  # 每30帧更新一次进度
-                        progress = 20 + int((frame_count / total_frames) * 50)
-                        progress_callback(progress, f"处理进度: {frame_count}/{total_frames}")
+                    heappush(pending, item)
+                    while pending and pending[0][0] == next_index:
+                        _, processed_frame = heappop(pending)
+                        write(processed_frame)
+                        next_index += 1
+                        
+                        # 更新进度
+                        if next_index % 30 == 0:  # 每30帧更新一次进度
+                            progress = 20 + int((next_index / total_frames) * 50)
+                            progress_callback(progress, f"处理进度: {next_index}/{total_frames}")
+                
+                if errors:
+                    raise errors[0]
                 
                 progress_callback(70, "视频帧处理完成")
                 
             finally:
-                out.release()
+                # 停止流水线并清空队列，确保所有线程退出后再释放资源
+                stop.set()
+                for thread in threads:
+                    while thread.is_alive():
+                        for q in (raw_q, done_q):
+                            try:
+                                while True:
+                                    q.get_nowait()
+                            except queue.Empty:
+                                pass
+                        thread.join(timeout=0.1)
+                
+                released = out.release()
+            
+            # FFmpeg写入器编码失败时返回False
+            if released is False:
+                raise EncoderError(out.encoder, f"FFmpeg failed to encode output video with {out.encoder}")
                 
         finally:
             cap.release()
     
-    def _merge_audio_with_ffmpeg(self, input_path: str, video_path: str, output_path: str):
-        """使用FFmpeg合并音频"""
-        import subprocess
+    def _regions_to_rects(self, regions: list, video_width: int, video_height: int) -> np.ndarray:
+        """
+        将水印区域转换为裁剪后的矩形数组，整个视频只需计算一次
         
-        try:
-            # 检查FFmpeg是否可用
-            if not check_ffmpeg_availability():
-                logger.warning("FFmpeg not available, skipping audio merge")
-                # 直接复制处理后的视频
-                import shutil
-                shutil.copy2(video_path, output_path)
-                return
-            
-            # 使用FFmpeg命令合并视频和音频
-            cmd = [
-                'ffmpeg', '-y',  # -y 覆盖输出文件
-                '-i', video_path,  # 处理后的视频
-                '-i', input_path,  # 原始文件（包含音频）
-                '-c:v', 'copy',    # 复制视频流
-                '-c:a', 'aac',     # 音频编码为AAC
-                '-map', '0:v:0',   # 使用第一个输入的视频流
-                '-map', '1:a:0?',  # 使用第二个输入的音频流（如果存在）
-                '-shortest',       # 以最短流为准
-                output_path
-            ]
+        Args:
+            regions: 水印区域列表，支持两种格式（见validate_regions）
+            video_width: 视频宽度
+            video_height: 视频高度
             
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        Returns:
+            np.ndarray: 形状为(N, 4)的int32数组，每行为[x1, y1, x2, y2]
+        """
+        rects = [
+            [r['x'], r['y'], r['x'] + r['width'], r['y'] + r['height']]
+            for r in self.validate_regions(regions, video_width, video_height)
+        ]
+        return np.array(rects, dtype=np.int32).reshape(-1, 4)
+    
+    def _build_mask(self, rects: np.ndarray, width: int, height: int) -> np.ndarray:
+        """
+        创建静态掩码 - 这是稳定版本的关键技术
+        
+        区域和尺寸在整个视频中不变，因此掩码只需分配一次
+        
+        Args:
+            rects: 由_regions_to_rects预先计算的水印矩形数组
+            width: 视频宽度
+            height: 视频高度
             
-            if result.returncode != 0:
-                logger.warning(f"FFmpeg failed, trying fallback: {result.stderr}")
-                # 如果FFmpeg失败，直接复制处理后的视频
-                import shutil
-                shutil.copy2(video_path, output_path)
-                
-        except (subprocess.TimeoutExpired, FileNotFoundError) as e:
-            logger.warning(f"FFmpeg not available or timeout: {e}")
-            # 如果FFmpeg不可用，直接复制处理后的视频
-            import shutil
-            shutil.copy2(video_path, output_path)
+        Returns:
+            np.ndarray: 单通道uint8掩码，水印区域为255
+        """
+        mask = np.zeros((height, width), dtype=np.uint8)
+        
+        # 将所有水印区域直接写入掩码（与cv2.rectangle一样包含右下角边界像素）
+        for x1, y1, x2, y2 in rects:
+            mask[y1:y2 + 1, x1:x2 + 1] = 255
+        
+        return mask
     
-    def _remove_watermark_from_frame(self, frame: np.ndarray, regions: list) -> np.ndarray:
+    def _inpaint_roi(self, rects: np.ndarray, width: int, height: int, pad: int = 8) -> Optional[tuple]:
+        """
+        计算所有水印区域外接矩形加边距后的切片，inpaint只需处理该区域
+        
+        边距需不小于inpaint半径，保证区域边缘的修复结果与整帧修复一致
+        
+        Args:
+            rects: 由_regions_to_rects预先计算的水印矩形数组
+            width: 视频宽度
+            height: 视频高度
+            pad: 外接矩形向外扩展的像素数
+            
+        Returns:
+            Optional[tuple]: (行切片, 列切片)，没有水印区域时为None
+        """
+        if len(rects) == 0:
+            return None
+        
+        x1, y1 = rects[:, :2].min(axis=0)
+        x2, y2 = rects[:, 2:].max(axis=0)
+        return (slice(max(0, y1 - pad), min(height, y2 + 1 + pad)),
+                slice(max(0, x1 - pad), min(width, x2 + 1 + pad)))
+    
+    def _inpaint_frame(self, frame: np.ndarray, mask: np.ndarray, rects: np.ndarray,
+                       roi: Optional[tuple] = None) -> np.ndarray:
         """
         从单帧中去除水印 - 使用稳定版本的算法
         
         Args:
             frame: 输入帧
-            regions: 水印区域列表，支持两种格式：
-                     - [x1, y1, x2, y2] (旧格式)
-                     - {'x': x, 'y': y, 'width': w, 'height': h} (新格式)
+            mask: 由_build_mask预先创建的静态掩码
+            rects: 水印矩形数组，仅用于高斯模糊备选方案
+            roi: 由_inpaint_roi计算的区域切片，指定时只对该区域inpaint并写回帧中
             
         Returns:
             np.ndarray: 处理后的帧
         """
-        if not regions:
+        if len(rects) == 0:
             return frame
         
-        # 创建静态掩码 - 这是稳定版本的关键技术
-        h, w = frame.shape[:2]
-        mask = np.zeros((h, w), dtype=np.uint8)
-        
-        # 将所有水印区域添加到掩码中
-        for region in regions:
-            # 处理不同的区域格式
-            if isinstance(region, dict):
-                # 新格式: {'x': x, 'y': y, 'width': w, 'height': h}
-                x = int(region.get('x', 0))
-                y = int(region.get('y', 0))
-                width = int(region.get('width', 0))
-                height = int(region.get('height', 0))
-                
-                # 确保坐标在有效范围内
-                x = max(0, min(x, w))
-                y = max(0, min(y, h))
-                width = max(0, min(width, w - x))
-                height = max(0, min(height, h - y))
-                
-                if width > 0 and height > 0:
-                    # 使用cv2.rectangle填充掩码区域
-                    cv2.rectangle(mask, (x, y), (x + width, y + height), 255, -1)
-                    
-            elif isinstance(region, (list, tuple)) and len(region) == 4:
-                # 旧格式: [x1, y1, x2, y2]
-                x1, y1, x2, y2 = [int(coord) for coord in region]
-                
-                # 确保坐标在有效范围内
-                x1 = max(0, min(x1, w))
-                y1 = max(0, min(y1, h))
-                x2 = max(x1, min(x2, w))
-                y2 = max(y1, min(y2, h))
-                
-                if x2 > x1 and y2 > y1:
-                    cv2.rectangle(mask, (x1, y1), (x2, y2), 255, -1)
+        # inpaint耗时与输入像素数成正比，水印通常只占画面很小一部分
+        region = frame[roi] if roi else frame
+        region_mask = mask[roi] if roi else mask
         
-        # 使用稳定版本的inpainting算法
         try:
-            # 使用INPAINT_NS算法 - 这是稳定版本使用的算法
-            inpainted_frame = cv2.inpaint(frame, mask, 3, cv2.INPAINT_NS)
-            return inpainted_frame
+            # 使用INPAINT_TELEA算法，半径1 - 对固定水印效果相当，速度远快于NS
+            inpainted = cv2.inpaint(region, region_mask, 1, cv2.INPAINT_TELEA)
             
         except Exception as e:
             logger.warning(f"Inpainting failed, using fallback: {e}")
             
-            # 如果inpainting失败，使用TELEA算法作为备选
+            # 如果TELEA失败，使用稳定版本的INPAINT_NS算法作为备选
             try:
-                inpainted_frame = cv2.inpaint(frame, mask, 3, cv2.INPAINT_TELEA)
-                return inpainted_frame
+                inpainted = cv2.inpaint(region, region_mask, 3, cv2.INPAINT_NS)
             except Exception as e2:
-                logger.warning(f"TELEA inpainting also failed: {e2}")
+                logger.warning(f"NS inpainting also failed: {e2}")
                 
                 # 最后的备选方案：对每个区域使用高斯模糊
-                result_frame = frame.copy()
-                for region in regions:
-                    if isinstance(region, dict):
-                        x = int(region.get('x', 0))
-                        y = int(region.get('y', 0))
-                        width = int(region.get('width', 0))
-                        height = int(region.get('height', 0))
-                        x2 = x + width
-                        y2 = y + height
-                    elif isinstance(region, (list, tuple)) and len(region) == 4:
-                        x, y, x2, y2 = [int(coord) for coord in region]
-                    else:
-                        continue
-                    
-                    # 确保坐标有效
-                    x = max(0, min(x, w))
-                    y = max(0, min(y, h))
-                    x2 = max(x, min(x2, w))
-                    y2 = max(y, min(y2, h))
-                    
+                # 帧由处理流水线独占，直接写回区域视图，避免复制整帧
+                for x, y, x2, y2 in rects:
                     if x2 > x and y2 > y:
-                        # 使用高斯模糊作为最后的备选方案
-                        region_data = result_frame[y:y2, x:x2]
-                        blurred = cv2.GaussianBlur(region_data, (15, 15), 0)
-                        result_frame[y:y2, x:x2] = blurred
+                        blur_roi = frame[y:y2, x:x2]
+                        cv2.GaussianBlur(blur_roi, (15, 15), 0, dst=blur_roi)
                 
-                return result_frame
+                return frame
+        
+        if roi is None:
+            return inpainted
+        frame[roi] = inpainted
+        return frame
     
     def validate_regions(self, regions: list, video_width: int, video_height: int) -> list:
         """
@@ -3,46 +3,78 @@
 Video Watermark Removal Quick Start Script
 """
 
+import io
 import os
 import sys
 import subprocess
+import threading
+import contextlib
+import importlib.util
 import webbrowser
-import time
+from pathlib import Path
+
+from core.utils import find_missing_packages
+
+# Directory containing this script, resolved once
+_HERE = Path(__file__).resolve().parent
 
 def check_dependencies():
     """Check dependencies"""
     print("🔍 Checking dependencies...")
     
-    try:
-        import cv2
-        import numpy
-        import flask
-        print("✅ All dependencies installed")
-        return True
-    except ImportError as e:
-        print(f"❌ Missing dependency: {e}")
+    missing = find_missing_packages()
+    if missing:
+        print(f"❌ Missing dependency: {', '.join(missing)}")
         print("Please run: pip3 install -r requirements.txt")
         return False
+    
+    print("✅ All dependencies installed")
+    return True
 
 def run_tests():
     """Run tests"""
     print("\n🧪 Running functional tests...")
     
     try:
-        result = subprocess.run([sys.executable, "test_video_watermark.py"], 
-                              capture_output=True, text=True, timeout=30)
+        # Run the test module in this interpreter instead of spawning a new one
+        try:
+            from tests import test_video_watermark
+        except ImportError as e:
+            print(f"ℹ️  Cannot import tests in-process ({e}), running them in a subprocess")
+            passed = run_tests_subprocess()
+        else:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                passed = test_video_watermark.main()
+            if not passed:
+                print(output.getvalue())
         
-        if result.returncode == 0:
+        if passed:
             print("✅ All tests passed")
             return True
         else:
             print("❌ Some tests failed")
-            print(result.stdout)
             return False
     except Exception as e:
         print(f"❌ Test execution failed: {e}")
         return False
 
+def run_tests_subprocess():
+    """Run the test script in a child interpreter, streaming its output as it is produced"""
+    script = _HERE / "tests" / "test_video_watermark.py"
+    process = subprocess.Popen([sys.executable, script], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True, bufsize=1)
+    try:
+        for line in process.stdout:
+            sys.stdout.write(line)
+    except KeyboardInterrupt:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+    
+    return process.wait() == 0
+
 def start_server():
     """Start server"""
     print("\n🚀 Starting Video Watermark Removal service...")
@@ -53,27 +85,51 @@ def start_server():
         print("Video Watermark Removal page: http://localhost:50001/")
         print("\nPress Ctrl+C to stop the server")
         
-        # Delay browser opening
-        def open_browser():
-            time.sleep(2)
-            webbrowser.open("http://localhost:50001/")
+        # Start Flask application in this process (the launcher has already checked its dependencies)
+        os.chdir(_HERE)
+        from app import create_app, cleanup_app
         
-        import threading
-        browser_thread = threading.Thread(target=open_browser)
-        browser_thread.daemon = True
-        browser_thread.start()
-        
-        # Start Flask application
-        os.chdir(os.path.dirname(os.path.abspath(__file__)))
-        subprocess.run([sys.executable, "app/routes.py"])
+        app = create_app()
+        try:
+            # Serve requests concurrently. The task queue and sessions live in this process,
+            # so use a multi-threaded server rather than prefork workers
+            if importlib.util.find_spec("waitress") is not None:
+                from waitress import create_server
+                server = create_server(app, host="127.0.0.1", port=50001, threads=2 * (os.cpu_count() or 1) + 1)
+                serve = server.run
+            else:
+                from werkzeug.serving import make_server
+                server = make_server("127.0.0.1", 50001, app, threaded=True)
+                serve = server.serve_forever
+            
+            # The server socket is already listening, so the browser's first request waits
+            # in the backlog until serving starts. Open it from a daemon thread: console
+            # browsers (lynx, w3m) block webbrowser.open until they exit
+            threading.Thread(target=webbrowser.open, args=("http://localhost:50001/",), daemon=True).start()
+            serve()
+        finally:
+            cleanup_app(app)
         
     except KeyboardInterrupt:
         print("\n👋 Server stopped")
     except Exception as e:
         print(f"❌ Failed to start server: {e}")
 
+def preload_dependencies():
+    """Import the heavy libraries used by the server so later imports hit sys.modules"""
+    try:
+        import cv2
+        import numpy
+    except ImportError:
+        # Reported by check_dependencies
+        pass
+
 def main():
     """Main function"""
+    # Load cv2/numpy in the background while dependency checks, tests and prompts run
+    preload_thread = threading.Thread(target=preload_dependencies, daemon=True)
+    preload_thread.start()
+    
     print("🎬 Video Watermark Removal Launcher")
     print("=" * 50)
     
@@ -89,6 +145,7 @@ def main():
             return
     
     # Start server
+    preload_thread.join(timeout=10)
     start_server()
 
 if __name__ == "__main__":
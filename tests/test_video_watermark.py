@@ -4,138 +4,238 @@ Video Watermark Removal Test Script
 For validating the demo version's basic functionality
 """
 
-import os
 import sys
+import threading
 import tempfile
-import requests
-import json
+import functools
+import importlib.util
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-# Add app directory to Python path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
+# Directory containing this script, resolved once
+_HERE = Path(__file__).resolve().parent
 
+# Add app directory and project root to Python path
+sys.path.insert(0, str(_HERE / 'app'))
+sys.path.insert(0, str(_HERE.parent))
+
+from core.utils import find_missing_packages
+
+# Output is collected and written to stdout once at the end of main(); lines logged from a
+# test running in a worker thread go to that thread's buffer instead
+_out = []
+_local = threading.local()
+
+def log(text=""):
+    """Buffer a line of output"""
+    getattr(_local, 'lines', _out).append(f"{text}\n")
+
+def _run_buffered(test_func):
+    """Run a test with its own output buffer, returning (result, buffered lines)"""
+    _local.lines = []
+    try:
+        return test_func(), _local.lines
+    finally:
+        del _local.lines
+
+def test(name):
+    """Decorator turning a check that raises on failure into one that reports and returns a bool"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper():
+            try:
+                func()
+                return True
+            except Exception as e:
+                log(f"❌ {name} failed: {e}")
+                return False
+        return wrapper
+    return decorator
+
+# Not a test itself; keep test collectors from picking it up
+test.__test__ = False
+
+def _imp(module_name, attr):
+    """Get an attribute from a module, reusing the module if it is already imported"""
+    module = sys.modules.get(module_name) or importlib.import_module(module_name)
+    return getattr(module, attr)
+
+@test("Model test")
 def test_video_watermark_models():
     """Test data models"""
-    print("🧪 Testing data models...")
+    log("🧪 Testing data models...")
     
-    try:
-        from video_watermark.models import VideoWatermarkTask, WatermarkRegion, TaskProcessingLog, storage
-        
-        # Test task creation
-        task = VideoWatermarkTask("test_video.mp4", 1024*1024, "mp4")
-        print(f"✅ Task created successfully: {task.task_uuid}")
-        
-        # Test task saving (using simplified storage)
-        if task.save():
-            print("✅ Task saved successfully")
-        else:
-            print("❌ Task saving failed")
-        
-        # Test task retrieval
-        retrieved_task = VideoWatermarkTask.get_by_uuid(task.task_uuid)
-        if retrieved_task:
-            print("✅ Task retrieval successful")
-        else:
-            print("❌ Task retrieval failed")
-        
-        # Test watermark regions
-        regions = [
-            {
-                'region_order': 1,
-                'x': 100,
-                'y': 100,
-                'width': 200,
-                'height': 150
-            }
-        ]
-        if storage.save_regions(task.task_uuid, regions):
-            print("✅ Watermark regions saved successfully")
-        else:
-            print("❌ Failed to save watermark regions")
-        
-        # Test region retrieval
-        retrieved_regions = storage.get_regions(task.task_uuid)
-        if retrieved_regions:
-            print("✅ Watermark regions retrieved successfully")
-        else:
-            print("❌ Failed to retrieve watermark regions")
-        
-        # Test logging
-        TaskProcessingLog.add_log(task.task_uuid, 'info', 'Test log message', 'test')
-        print("✅ Log recorded successfully")
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ Model test failed: {e}")
-        return False
+    VideoWatermarkTask = _imp("video_watermark.models", "VideoWatermarkTask")
+    TaskProcessingLog = _imp("video_watermark.models", "TaskProcessingLog")
+    storage = _imp("video_watermark.models", "storage")
+    
+    # Test task creation
+    task = VideoWatermarkTask("test_video.mp4", 1024*1024, "mp4")
+    log(f"✅ Task created successfully: {task.task_uuid}")
+    
+    # Test task saving (using simplified storage)
+    if task.save():
+        log("✅ Task saved successfully")
+    else:
+        log("❌ Task saving failed")
+    
+    # Test task retrieval
+    retrieved_task = VideoWatermarkTask.get_by_uuid(task.task_uuid)
+    if retrieved_task:
+        log("✅ Task retrieval successful")
+    else:
+        log("❌ Task retrieval failed")
+    
+    # Test watermark regions
+    regions = [
+        {
+            'region_order': 1,
+            'x': 100,
+            'y': 100,
+            'width': 200,
+            'height': 150
+        }
+    ]
+    if storage.save_regions(task.task_uuid, regions):
+        log("✅ Watermark regions saved successfully")
+    else:
+        log("❌ Failed to save watermark regions")
+    
+    # Test region retrieval
+    retrieved_regions = storage.get_regions(task.task_uuid)
+    if retrieved_regions:
+        log("✅ Watermark regions retrieved successfully")
+    else:
+        log("❌ Failed to retrieve watermark regions")
+    
+    # Test logging
+    TaskProcessingLog.add_log(task.task_uuid, 'info', 'Test log message', 'test')
+    log("✅ Log recorded successfully")
 
+@test("Video processor test")
 def test_video_processor():
     """Test video processor"""
-    print("\n🎬 Testing video processor...")
+    log("\n🎬 Testing video processor...")
     
-    try:
-        from video_watermark.video_processor import VideoProcessor
-        
-        processor = VideoProcessor()
-        print("✅ Video processor initialized successfully")
-        
-        # Note: A real video file is needed for testing
-        # In actual deployment, a small test video file can be created
-        print("ℹ️  Video processor functionality requires real video files for complete testing")
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ Video processor test failed: {e}")
-        return False
+    VideoProcessor = _imp("video_watermark.video_processor", "VideoProcessor")
+    
+    processor = VideoProcessor()
+    log("✅ Video processor initialized successfully")
+    
+    # Note: A real video file is needed for testing
+    # In actual deployment, a small test video file can be created
+    log("ℹ️  Video processor functionality requires real video files for complete testing")
 
+@test("API endpoint test")
 def test_api_endpoints():
     """Test API endpoints (server needs to be running)"""
-    print("\n🌐 Testing API endpoints...")
+    log("\n🌐 Testing API endpoints...")
     
     # Just checking if routes are correctly imported
-    try:
-        from video_watermark.routes import video_watermark_bp
-        print("✅ API routes imported successfully")
-        
-        # Check routes in blueprint (simplified version)
-        print("📋 Available API endpoints:")
-        print("   POST /api/video/upload - Upload video")
-        print("   GET /api/video/task/{uuid}/frames - Get video frames")
-        print("   POST /api/video/task/{uuid}/select-frame - Select frame")
-        print("   POST /api/video/task/{uuid}/select-regions - Submit watermark regions")
-        print("   GET /api/video/task/{uuid}/status - Check task status")
-        print("   GET /api/video/task/{uuid}/download - Download result")
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ API endpoint test failed: {e}")
-        return False
+    video_watermark_bp = _imp("video_watermark.routes", "video_watermark_bp")
+    log("✅ API routes imported successfully")
+    
+    # Check routes in blueprint (simplified version)
+    log("📋 Available API endpoints:")
+    log("   POST /api/video/upload - Upload video")
+    log("   GET /api/video/task/{uuid}/frames - Get video frames")
+    log("   POST /api/video/task/{uuid}/select-frame - Select frame")
+    log("   POST /api/video/task/{uuid}/select-regions - Submit watermark regions")
+    log("   GET /api/video/task/{uuid}/status - Check task status")
+    log("   GET /api/video/task/{uuid}/download - Download result")
+
+@test("Time segment planning test")
+def test_plan_time_segments():
+    """Check keyframe widening, merging and validation in WatermarkProcessor._plan_time_segments"""
+    log("\n⏱️  Testing time segment planning...")
+    
+    plan = _imp("processors.watermark", "WatermarkProcessor")._plan_time_segments
+    keyframes = [0.0, 2.0, 4.0, 6.0, 8.0]
+    
+    # Ranges widen outward to keyframes; overlapping results merge into one delogo segment
+    segments = plan([{'start': 2.5, 'end': 3.5}, {'start': 3.8, 'end': 4.5}], keyframes, 10.0)
+    assert segments == [(0.0, 2.0, False), (2.0, 6.0, True), (6.0, 10.0, False)], segments
+    
+    # A missing end runs to the end of the video
+    segments = plan([{'start': 8.5, 'end': None}], keyframes, 10.0)
+    assert segments == [(0.0, 8.0, False), (8.0, 10.0, True)], segments
+    
+    for invalid in (["1-2"], [{'start': 'abc', 'end': 2}], [{'start': 1, 'end': float('nan')}], {'start': 1}):
+        try:
+            plan(invalid, keyframes, 10.0)
+        except ValueError:
+            continue
+        raise AssertionError(f"invalid time ranges accepted: {invalid!r}")
+    log("✅ Time segments widened to keyframes, merged and validated")
 
+@test("Time range delogo integration test")
+def test_time_range_delogo():
+    """Run the time-range delogo path on real FFmpeg-generated clips (MP4, and MPEG-TS with a non-zero start time)"""
+    log("\n🎞️  Testing time range delogo with FFmpeg...")
+    
+    import shutil
+    import subprocess
+    if not (shutil.which("ffmpeg") and shutil.which("ffprobe")):
+        log("ℹ️  FFmpeg/ffprobe not installed, skipping")
+        return
+    
+    WatermarkProcessor = _imp("processors.watermark", "WatermarkProcessor")
+    processor = WatermarkProcessor(storage_manager=None)
+    regions = [{'x': 20, 'y': 20, 'width': 60, 'height': 40}]
+    
+    def frame_hashes(path):
+        result = subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-map", "0:v:0", "-f", "framemd5", "-"],
+                                capture_output=True, text=True, check=True)
+        return [line.rsplit(",", 1)[1].strip() for line in result.stdout.splitlines() if not line.startswith("#")]
+    
+    with tempfile.TemporaryDirectory() as work_dir:
+        for ext in ("mp4", "ts"):
+            # 6 s at 25 fps with a keyframe every second
+            source = str(Path(work_dir) / f"source.{ext}")
+            subprocess.run(["ffmpeg", "-y", "-v", "error",
+                            "-f", "lavfi", "-i", "testsrc=size=320x240:rate=25:duration=6",
+                            "-f", "lavfi", "-i", "sine=duration=6",
+                            "-c:v", "libx264", "-g", "25", "-keyint_min", "25", "-sc_threshold", "0",
+                            "-pix_fmt", "yuv420p", "-c:a", "aac", source], check=True)
+            
+            output = str(Path(work_dir) / f"output_{ext}.mp4")
+            ok = processor._remove_watermark_in_time_ranges(source, output, regions, [{'start': 2.2, 'end': 3.1}],
+                                                            lambda *args: None)
+            assert ok, f"{ext}: time range processing failed"
+            
+            tag = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0",
+                                  "-show_entries", "stream=codec_tag_string", "-of", "csv=p=0", output],
+                                 capture_output=True, text=True, check=True).stdout.strip()
+            assert tag == "avc3", f"{ext}: expected avc3 sample entry, got {tag}"
+            
+            # The range widens to keyframes [2 s, 4 s): frames 50-99 are re-encoded, the rest copied unchanged
+            expected, actual = frame_hashes(source), frame_hashes(output)
+            assert len(actual) == len(expected) == 150, f"{ext}: frame count {len(actual)} != {len(expected)}"
+            copied = list(range(50)) + list(range(100, 150))
+            mismatched = [i for i in copied if actual[i] != expected[i]]
+            assert not mismatched, f"{ext}: copied frames differ from source at {mismatched[:5]}"
+            assert any(actual[i] != expected[i] for i in range(50, 100)), f"{ext}: watermark range was not processed"
+    log("✅ Time range delogo output matches the source outside the processed range")
+
+@functools.lru_cache(maxsize=1)
+def _ensure_storage():
+    """Create the temporary storage directory once and return its absolute path"""
+    temp_storage_dir = Path("temp_storage")
+    temp_storage_dir.mkdir(parents=True, exist_ok=True)
+    return temp_storage_dir.absolute()
+
+@test("Storage directory check")
 def check_storage_directory():
     """Check storage directory"""
-    print("\n📁 Checking storage directory...")
+    log("\n📁 Checking storage directory...")
     
-    try:
-        temp_storage_dir = Path("temp_storage")
-        if not temp_storage_dir.exists():
-            temp_storage_dir.mkdir(exist_ok=True)
-            print("✅ Temporary storage directory created")
-        else:
-            print("✅ Temporary storage directory already exists")
-        
-        print(f"   Storage location: {temp_storage_dir.absolute()}")
-        return True
-        
-    except Exception as e:
-        print(f"❌ Storage directory check failed: {e}")
-        return False
+    temp_storage_dir = _ensure_storage()
+    log("✅ Temporary storage directory ready")
+    log(f"   Storage location: {temp_storage_dir}")
 
 def check_dependencies():
     """Check dependencies"""
-    print("\n📦 Checking dependencies...")
+    log("\n📦 Checking dependencies...")
     
     required_packages = [
         'cv2',
@@ -143,74 +243,78 @@ def check_dependencies():
         'flask'
     ]
     
-    missing_packages = []
+    missing_packages = find_missing_packages(tuple(required_packages))
     
     for package in required_packages:
-        try:
-            if package == 'cv2':
-                import cv2
-            elif package == 'numpy':
-                import numpy
-            elif package == 'flask':
-                import flask
-            
-            print(f"✅ {package} installed")
-            
-        except ImportError:
-            missing_packages.append(package)
-            print(f"❌ {package} not installed")
+        if package in missing_packages:
+            log(f"❌ {package} not installed")
+        else:
+            log(f"✅ {package} installed")
     
     if missing_packages:
-        print(f"\n⚠️  Missing dependencies: {', '.join(missing_packages)}")
-        print("Please run: pip install -r requirements.txt")
+        log(f"\n⚠️  Missing dependencies: {', '.join(missing_packages)}")
+        log("Please run: pip install -r requirements.txt")
         return False
     
     return True
 
 def main():
     """Main test function"""
-    print("🚀 Video Watermark Removal Test Starting...\n")
-    
-    tests = [
-        ("依赖项检查", check_dependencies),
-        ("存储目录检查", check_storage_directory),
-        ("数据模型测试", test_video_watermark_models),
-        ("视频处理器测试", test_video_processor),
-        ("API 端点测试", test_api_endpoints)
-    ]
-    
-    passed = 0
-    total = len(tests)
-    
-    for test_name, test_func in tests:
-        print(f"{'='*50}")
-        print(f"测试: {test_name}")
-        print(f"{'='*50}")
+    try:
+        log("🚀 Video Watermark Removal Test Starting...\n")
         
-        if test_func():
-            passed += 1
-            print(f"✅ {test_name} 通过")
+        tests = [
+            ("依赖项检查", check_dependencies),
+            ("存储目录检查", check_storage_directory),
+            ("数据模型测试", test_video_watermark_models),
+            ("视频处理器测试", test_video_processor),
+            ("API 端点测试", test_api_endpoints),
+            ("时间段规划测试", test_plan_time_segments),
+            ("时间段去水印集成测试", test_time_range_delogo)
+        ]
+        
+        passed = 0
+        total = len(tests)
+        
+        # The checks are independent, so run them concurrently; each thread's output is
+        # buffered and emitted in the original order once all tests finish
+        with ThreadPoolExecutor(max_workers=total) as executor:
+            results = list(executor.map(lambda test: _run_buffered(test[1]), tests))
+        
+        for (test_name, _), (ok, lines) in zip(tests, results):
+            log(f"{'='*50}")
+            log(f"测试: {test_name}")
+            log(f"{'='*50}")
+            _out.extend(lines)
+            
+            if ok:
+                passed += 1
+                log(f"✅ {test_name} 通过")
+            else:
+                log(f"❌ {test_name} 失败")
+        
+        log(f"\n{'='*50}")
+        log(f"测试结果: {passed}/{total} 通过")
+        log(f"{'='*50}")
+        
+        if passed == total:
+            log("🎉 所有测试通过！视频去水印功能准备就绪。")
+            log("\n📝 下一步:")
+            log("1. 启动 Flask 应用: python app/routes.py")
+            log("2. 访问 http://localhost:50001/video-watermark.html")
+            log("3. 上传测试视频进行完整功能验证")
+            log("\n💡 提示:")
+            log("- 使用内存和文件存储，无需数据库")
+            log("- 支持 MP4, MOV, AVI, MKV 格式")
+            log("- 文件大小限制 500MB")
         else:
-            print(f"❌ {test_name} 失败")
-    
-    print(f"\n{'='*50}")
-    print(f"测试结果: {passed}/{total} 通过")
-    print(f"{'='*50}")
-    
-    if passed == total:
-        print("🎉 所有测试通过！视频去水印功能准备就绪。")
-        print("\n📝 下一步:")
-        print("1. 启动 Flask 应用: python app/routes.py")
-        print("2. 访问 http://localhost:50001/video-watermark.html")
-        print("3. 上传测试视频进行完整功能验证")
-        print("\n💡 提示:")
-        print("- 使用内存和文件存储，无需数据库")
-        print("- 支持 MP4, MOV, AVI, MKV 格式")
-        print("- 文件大小限制 500MB")
-    else:
-        print("⚠️  部分测试失败，请检查上述错误信息。")
-    
-    return passed == total
+            log("⚠️  部分测试失败，请检查上述错误信息。")
+        
+        return passed == total
+    finally:
+        # Emit the whole report with a single write
+        sys.stdout.write("".join(_out))
+        _out.clear()
 
 if __name__ == "__main__":
     success = main()